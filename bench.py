@@ -0,0 +1,279 @@
+"""
+Офлайн-нагрузочный тест bot.py.
+
+Гоняет настоящие хендлеры (add_cmd, post_challenge, check_answer, profile_cmd,
+leaderboard_cmd) синтетическими апдейтами от тысяч "пользователей".
+Telegram подменён FakeBot (ничего не уходит в сеть, все отправки пишутся в память),
+БД — локальный Postgres (сеть не нужна).
+
+ВНИМАНИЕ: схема public в BENCH_DATABASE_URL пересоздаётся с нуля.
+Поэтому имя базы должно содержать "bench" (или запускай с --force).
+
+    createdb nick_bench
+    BENCH_DATABASE_URL=postgresql://localhost/nick_bench python bench.py --users 2000
+
+Отчёт: p50/p95/p99 латентности по хендлерам, пропускная способность
+и число запросов к БД на один апдейт.
+
+По умолчанию лимиты outbox (20 сообщений/мин в группу и т.д.) сняты: иначе p95
+post_challenge — это ожидание очереди, а не работа хендлера. --paced оставляет
+настоящие лимиты.
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict
+
+from telegram import Update
+from telegram.ext import Application, ExtBot
+
+import bot
+
+BENCH_CHAT_ID = -1001234567890
+BENCH_THREAD_ID = 7
+ADMIN_ID = 1
+UNPACED_RATE = 1e9  # токенов/с — outbox фактически не ждёт
+
+
+# =========================
+# FAKE TELEGRAM
+# =========================
+class FakeBot(ExtBot):
+    """ExtBot без сети: вместо HTTP-запросов к Bot API возвращает правдоподобные ответы."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # атрибуты Bot заморожены после __init__
+        with self._unfrozen():
+            self.sent: List[tuple] = []
+            self._message_ids = itertools.count(1)
+
+    def _fake_message(self, data: dict) -> dict:
+        chat_id = int(data.get("chat_id", 0))
+        msg = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        }
+        if "text" in data:
+            msg["text"] = data["text"]
+        if "photo" in data:
+            msg["photo"] = [{"file_id": f"fake-{msg['message_id']}", "file_unique_id": "u",
+                             "width": 1, "height": 1}]
+        return msg
+
+    async def _do_post(self, endpoint: str, data: dict, *args, **kwargs):
+        self.sent.append((endpoint, data))
+        if endpoint == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "bench", "username": "nick_encoder_bot"}
+        if endpoint == "getChatMember":
+            return {"status": "creator", "is_anonymous": False,
+                    "user": {"id": int(data["user_id"]), "is_bot": False, "first_name": "admin"}}
+        if endpoint in ("sendMessage", "sendPhoto"):
+            return self._fake_message(data)
+        return True
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+def make_update(app: Application, user_id: int, text: str,
+                chat_id: Optional[int] = None, thread_id: Optional[int] = None) -> Update:
+    chat_id = user_id if chat_id is None else chat_id
+    msg = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                 "username": f"user{user_id}"},
+        "text": text,
+    }
+    if thread_id is not None:
+        msg["message_thread_id"] = thread_id
+        msg["is_topic_message"] = True
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": next(_update_ids), "message": msg}, app.bot)
+
+
+# =========================
+# DB ROUND TRIPS
+# =========================
+_db_calls: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("db_calls", default=None)
+
+class CountingCursor(psycopg.AsyncCursor):
+    """Считает запросы текущего апдейта (через contextvar — параллельные апдейты не мешают)."""
+
+    async def execute(self, query, params=None, **kwargs):
+        counter = _db_calls.get()
+        if counter is not None:
+            counter[0] += 1
+        return await super().execute(query, params, **kwargs)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        counter = _db_calls.get()
+        if counter is not None:
+            counter[0] += 1
+        return await super().executemany(query, params_seq, **kwargs)
+
+
+# =========================
+# STATS
+# =========================
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {}
+        self.db_calls: Dict[str, int] = {}
+        self.wall: Dict[str, float] = {}
+
+    async def measure(self, name: str, coro) -> None:
+        counter = [0]
+        token = _db_calls.set(counter)
+        t0 = time.perf_counter()
+        try:
+            await coro
+        finally:
+            dt = time.perf_counter() - t0
+            _db_calls.reset(token)
+        self.latencies.setdefault(name, []).append(dt)
+        self.db_calls[name] = self.db_calls.get(name, 0) + counter[0]
+
+    def report(self) -> str:
+        lines = [
+            f"{'handler':<16} {'n':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'upd/s':>9} {'db/upd':>7}",
+        ]
+        for name, values in self.latencies.items():
+            values = sorted(values)
+            n = len(values)
+
+            def pct(p: float) -> float:
+                return values[min(n - 1, int(p * n))] * 1000
+
+            wall = self.wall.get(name) or sum(values)
+            lines.append(
+                f"{name:<16} {n:>7} {pct(0.50):>9.2f} {pct(0.95):>9.2f} {pct(0.99):>9.2f} "
+                f"{n / wall if wall else 0:>9.0f} {self.db_calls[name] / n:>7.2f}"
+            )
+        return "\n".join(lines)
+
+
+# =========================
+# SCENARIOS
+# =========================
+async def reset_schema(dsn: str) -> None:
+    async with await psycopg.AsyncConnection.connect(dsn, autocommit=True) as conn:
+        await conn.execute("DROP SCHEMA public CASCADE;")
+        await conn.execute("CREATE SCHEMA public;")
+
+async def run_phase(stats: Stats, name: str, jobs, concurrency: int) -> None:
+    """jobs — список корутин-фабрик; каждая гоняет свою последовательность апдейтов."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def worker(job):
+        async with sem:
+            await job()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(job) for job in jobs))
+    stats.wall[name] = time.perf_counter() - t0
+
+async def run(args: argparse.Namespace) -> Stats:
+    stats = Stats()
+    rnd = random.Random(args.seed)
+
+    if not args.paced:
+        bot.OUTBOX_GROUP_RATE = bot.OUTBOX_PRIVATE_RATE = UNPACED_RATE
+        bot.outbox._global = bot.TokenBucket(UNPACED_RATE, UNPACED_RATE)
+
+    app = Application.builder().bot(FakeBot(token="1:bench")).build()
+    bot.register_handlers(app)
+    await app.initialize()
+    await bot.on_startup(app, cursor_factory=CountingCursor)
+
+    async def send(name: str, update: Update) -> None:
+        await stats.measure(name, app.process_update(update))
+
+    try:
+        # 1) наполняем очередь
+        payloads = [f"https://example.com/ctf/{i}?k={rnd.getrandbits(32):08x}" for i in range(args.queue)]
+        jobs = [
+            (lambda p=p: send("add_cmd", make_update(app, ADMIN_ID, f"/add {p}")))
+            for p in payloads
+        ]
+        await run_phase(stats, "add_cmd", jobs, args.concurrency)
+
+        # 2) ежедневные посты (последний остаётся активным)
+        for _ in range(args.posts):
+            await stats.measure("post_challenge", bot.post_challenge(app, BENCH_CHAT_ID))
+        current = await bot.get_active_challenge(BENCH_CHAT_ID, BENCH_THREAD_ID)
+        answer = current["answer"]
+
+        # 3) "раш" ответов: у каждого пользователя несколько неверных попыток, затем верный ответ
+        user_ids = list(range(1000, 1000 + args.users))
+
+        def answer_job(user_id: int):
+            async def job():
+                for _ in range(rnd.randint(0, args.wrong)):
+                    await send("check_answer", make_update(app, user_id, f"wrong-{rnd.random()}"))
+                await send("check_answer", make_update(app, user_id, answer))
+            return job
+
+        await run_phase(stats, "check_answer", [answer_job(u) for u in user_ids], args.concurrency)
+
+        # 4) просмотр профилей и лидерборда
+        jobs = [
+            (lambda u=rnd.choice(user_ids): send("profile_cmd", make_update(app, u, "/profile")))
+            for _ in range(args.reads)
+        ]
+        await run_phase(stats, "profile_cmd", jobs, args.concurrency)
+        jobs = [
+            (lambda u=rnd.choice(user_ids): send("leaderboard_cmd", make_update(app, u, "/leaderboard")))
+            for _ in range(args.reads)
+        ]
+        await run_phase(stats, "leaderboard_cmd", jobs, args.concurrency)
+    finally:
+        await bot.on_shutdown(app)
+        await app.shutdown()
+
+    print(f"Telegram API calls recorded: {len(app.bot.sent)}", file=sys.stderr)
+    return stats
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline load test for bot.py")
+    parser.add_argument("--users", type=int, default=2000, help="сколько пользователей отвечает")
+    parser.add_argument("--wrong", type=int, default=3, help="макс. неверных попыток на пользователя")
+    parser.add_argument("--queue", type=int, default=200, help="сколько /add перед постом")
+    parser.add_argument("--posts", type=int, default=5, help="сколько раз вызвать post_challenge")
+    parser.add_argument("--reads", type=int, default=500, help="сколько /profile и /leaderboard")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--paced", action="store_true",
+                        help="не снимать лимиты outbox (латентность поста включит ожидание очереди)")
+    parser.add_argument("--force", action="store_true", help="разрешить базу без 'bench' в имени")
+    args = parser.parse_args()
+
+    dsn = os.getenv("BENCH_DATABASE_URL")
+    if not dsn:
+        raise SystemExit("Set BENCH_DATABASE_URL (local Postgres, its public schema will be dropped)")
+    dbname = conninfo_to_dict(dsn).get("dbname", "")
+    if "bench" not in dbname and not args.force:
+        raise SystemExit(f"Refusing to drop schema in {dbname!r}: use a *bench* database or --force")
+
+    bot.DATABASE_URL = dsn
+    bot.TARGET_CHAT_ID = BENCH_CHAT_ID
+    bot.MINI_CTF_THREAD_ID = BENCH_THREAD_ID
+
+    asyncio.run(reset_schema(dsn))
+    stats = asyncio.run(run(args))
+    print(stats.report())
+
+if __name__ == "__main__":
+    main()
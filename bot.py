@@ -1,23 +1,46 @@
 import os
+import sys
+import asyncio
+import bisect
+import functools
+import heapq
+import io
+import logging
+import math
 import random
+import re
+import socket
+import threading
+from time import monotonic, perf_counter
 import base64
 import binascii
+import csv
+import difflib
+import tempfile
 import urllib.parse
-from datetime import time
-from typing import Tuple, Optional, List
+from datetime import date, datetime, time
+from collections import OrderedDict, deque
+from typing import Tuple, Optional, List, Dict, Deque, Iterable, Iterator, Callable, Awaitable
 
 import psycopg
+from psycopg import sql
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 
-from telegram import Update
+from PIL import Image, ImageDraw, ImageFont
+
+from telegram import Bot, Message, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
 # =========================
 # ENV / CONFIG
@@ -29,7 +52,28 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 # то создай переменную DATABASE_URL и вставь туда это значение.
 DATABASE_URL = os.getenv("DATABASE_URL") or os.getenv("Postgres_DATABASE_URL")
 
-# Основной чат (группа) куда постим
+# Как получать апдейты: "polling" (по умолчанию) или "webhook" (HTTP-сервер, Telegram шлёт сам).
+# Для webhook: WEBHOOK_URL — публичный адрес (https://...), слушаем WEBHOOK_LISTEN:WEBHOOK_PORT
+# (на Railway порт приходит в PORT), путь WEBHOOK_PATH, WEBHOOK_SECRET проверяется в заголовке.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8443")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Сколько апдейтов обрабатываем одновременно (апдейты одного пользователя — всё равно по очереди)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# Пул соединений к Postgres (границы пула, таймаут ожидания свободного соединения, сек)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Основной чат (группа) куда постим.
+# Чатов может быть много — настройки каждого в таблице chat_settings (/setup, /settime, /setmethods).
+# TARGET_CHAT_ID + MINI_CTF_THREAD_ID — чат "по умолчанию": при старте заводится в chat_settings,
+# и в него идут /add из лички.
 TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", "0"))
 
 # ID ветки (topic) Mini-CTF / Игры
@@ -37,7 +81,104 @@ MINI_CTF_THREAD_ID = int(os.getenv("MINI_CTF_THREAD_ID", "0"))
 
 # ТЗ (для job queue; Railway / Linux обычно читает TZ)
 # Поставь в Variables: TZ=America/Los_Angeles
-DAILY_POST_TIME = time(hour=9, minute=0)  # 09:00
+DAILY_POST_TIME = time(hour=9, minute=0)  # 09:00 — время поста для новых чатов
+
+# Планировщик раз в SCHEDULER_INTERVAL сек ищет чаты, которым пора постить,
+# и постит не больше POST_CONCURRENCY одновременно
+SCHEDULER_INTERVAL = 60
+POST_CONCURRENCY = int(os.getenv("POST_CONCURRENCY", "8"))
+
+# Лидерборд: сколько верхних мест держим в памяти, размер страницы /leaderboard,
+# как часто (сек) перечитывать из БД (решения, засчитанные другими процессами)
+LEADERBOARD_TOP_N = int(os.getenv("LEADERBOARD_TOP_N", "100"))
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_TTL = float(os.getenv("LEADERBOARD_TTL", "60"))
+
+# Исходящие сообщения (лимиты Bot API): всего ~30 msg/s, в один чат ~1 msg/s,
+# в группу ~20 msg/min. Держимся чуть ниже.
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "28"))
+OUTBOX_PRIVATE_RATE = 1.0
+OUTBOX_GROUP_RATE = 20 / 60
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_MAX_RETRIES = 5
+TELEGRAM_MAX_TEXT = 4096
+
+# Анти-брутфорс ответов в личке: в среднем ANSWER_RATE попыток/сек, запас ANSWER_BURST.
+# Кто превысил — кулдаун ANSWER_COOLDOWN сек, за каждый повтор вдвое дольше (до ANSWER_COOLDOWN_MAX).
+# Счётчики попыток пишутся в users.attempts пачкой раз в ATTEMPTS_FLUSH_INTERVAL сек.
+ANSWER_RATE = float(os.getenv("ANSWER_RATE", "0.5"))
+ANSWER_BURST = float(os.getenv("ANSWER_BURST", "5"))
+ANSWER_COOLDOWN = 10.0
+ANSWER_COOLDOWN_MAX = 600.0
+ATTEMPTS_FLUSH_INTERVAL = float(os.getenv("ATTEMPTS_FLUSH_INTERVAL", "30"))
+
+# Кеш профилей пользователей (LRU): сколько держим и сколько сек доверяем solves/rank
+# (их могут поменять другие процессы)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# Метрики: локальный HTTP-эндпоинт в формате Prometheus (0 = выключен).
+# PROFILER_ENABLED=1 разрешает включать семплирующий профайлер через этот же эндпоинт.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+
+# Несколько процессов бота: плановые задачи (ежедневный пост) выполняет только лидер —
+# тот, кто держит session-level advisory lock LEADER_LOCK_KEY. Упал лидер — соединение
+# закрылось, lock отпущен, через LEADER_CHECK_INTERVAL сек его заберёт другой процесс.
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", "7310001"))
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "10"))
+# Архив: неактивные задания старше RETENTION_DAYS дней (0 = не архивировать) вместе с их
+# решениями переезжают в *_archive раз в ARCHIVE_INTERVAL сек пачками по ARCHIVE_BATCH_SIZE заданий.
+# users.solves — отдельный счётчик, архивация его не меняет.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+
+# Миграции схемы при старте: несколько процессов не накатывают их одновременно
+MIGRATIONS_LOCK_KEY = int(os.getenv("MIGRATIONS_LOCK_KEY", "7310002"))
+
+# Задания готовятся заранее (prepare_job раз в PREPARE_INTERVAL сек): у каждого чата
+# PREPARE_AHEAD готовых к отправке заданий в prepared_challenges — шифр, подсказка,
+# текст сообщения с проверенной разметкой, картинка (для чатов с /setimage)
+PREPARE_INTERVAL = float(os.getenv("PREPARE_INTERVAL", "600"))
+PREPARE_AHEAD = int(os.getenv("PREPARE_AHEAD", "3"))
+# Забранное на пост задание помечается (claimed_at/claimed_by) и удаляется при активации;
+# процесс упал между отправкой и активацией — prepare_job вернёт задание через столько сек
+PREPARE_CLAIM_TIMEOUT = float(os.getenv("PREPARE_CLAIM_TIMEOUT", "900"))
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+TELEGRAM_MAX_CAPTION = 1024
+IMAGE_FONT_PATH = os.getenv("IMAGE_FONT_PATH", "DejaVuSansMono.ttf")
+IMAGE_FONT_SIZE = 28
+IMAGE_MAX_COLS = 40
+IMAGE_PADDING = 24
+
+# /stats: гистограмма времени решения (сек от поста) — границы корзин; медиана считается по ней
+SOLVE_TIME_BUCKETS = [60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600]
+STATS_RECENT_CHALLENGES = 3
+STATS_DAYS = 7
+
+# Сложность задания (per-chat, /setdifficulty): сколько слоёв шифрования в цепочке
+MAX_DIFFICULTY = 3
+
+# /decode: перебор цепочек до SOLVER_MAX_DEPTH шагов, на каждом уровне держим SOLVER_BEAM
+# лучших промежуточных вариантов; весь поиск — не дольше SOLVER_TIME_BUDGET сек
+SOLVER_MAX_DEPTH = 3
+SOLVER_BEAM = 32
+SOLVER_TIME_BUDGET = 0.5
+SOLVER_RESULTS = 3
+XOR_MAX_KEY = 8
+# /decode не отвечает, если вход или расшифровка совпадает с живым заданием хотя бы на
+# SPOILER_SHARE длины (кусками от SPOILER_MIN_BLOCK символов): правка в пару символов не спасает
+SPOILER_SHARE = 0.7
+SPOILER_MIN_BLOCK = 4
+# короткий шифротекст: по частотам колонки байт ключа угадывается неточно — из XOR_KEY_OPTIONS
+# лучших байтов каждой колонки выбираем тот, что даёт лучший текст целиком
+XOR_KEY_OPTIONS = 8
+XOR_REFINE_MAX_COLUMN = 32
+
+# Канал Postgres LISTEN/NOTIFY: "активное задание в чате сменилось" (payload "chat_id:thread_id")
+ACTIVE_CHALLENGE_CHANNEL = "active_challenge"
 
 METHODS = ["caesar", "rot13", "base64", "hex", "url", "xor", "reverse"]
 ALPHABET = "abcdefghijklmnopqrstuvwxyz"
@@ -51,59 +192,647 @@ RANKS = [
     (20, "👑 Legend"),
 ]
 
+logger = logging.getLogger(__name__)
+
+
+# =========================
+# METRICS
+# =========================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последний — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    Простейший реестр метрик: счётчики, гистограммы и gauge с одной меткой.
+    Всё живёт в event loop, поэтому без блокировок.
+    """
+
+    def __init__(self) -> None:
+        self.counters: Dict[Tuple[str, str, str], float] = {}
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self.gauges: Dict[str, float] = {}
+        self.help: Dict[str, str] = {}
+
+    def describe(self, name: str, text: str) -> None:
+        self.help[name] = text
+
+    def inc(self, name: str, label: str, value: str, amount: float = 1) -> None:
+        key = (name, label, value)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, label: str, value: str, seconds: float) -> None:
+        key = (name, label, value)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(seconds)
+
+    def set(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def render(self) -> str:
+        lines: List[str] = []
+        seen = set()
+
+        def header(name: str, kind: str) -> None:
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, label, value), amount in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f'{name}{{{label}="{value}"}} {amount}')
+        for (name, label, value), hist in sorted(self.histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(hist.buckets, hist.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {hist.count}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {hist.sum}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {hist.count}')
+        for name, value in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "Update handler latency")
+metrics.describe("bot_handler_errors_total", "Update handlers that raised")
+metrics.describe("bot_db_seconds", "DB helper latency")
+metrics.describe("bot_db_errors_total", "DB helpers that raised")
+metrics.describe("bot_telegram_api_seconds", "Telegram Bot API request latency")
+metrics.describe("bot_telegram_api_errors_total", "Telegram Bot API requests with non-2xx status")
+metrics.describe("bot_event_loop_lag_seconds", "How late the event loop woke up a 0.5s sleep")
+metrics.describe("bot_outbox_pending", "Messages waiting in the outbox")
+metrics.describe("bot_outbox_retries_total", "Outbox send retries")
+metrics.describe("bot_answers_limited_total", "Answer attempts rejected by the per-user limiter")
+metrics.describe("bot_is_leader", "1 if this process runs scheduled jobs")
+metrics.describe("bot_archived_total", "Rows moved to the archive tables")
+metrics.describe("bot_queue_rejected_total", "Queued payloads dropped because they cannot be posted")
+
+def timed_handler(callback):
+    """Обёртка для callback'ов CommandHandler/MessageHandler/job: латентность + ошибки."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        t0 = perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", "handler", name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", "handler", name, perf_counter() - t0)
+    return wrapper
+
+def timed_db(func):
+    """Декоратор для DB-хелперов: латентность + ошибки по имени функции."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        t0 = perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc("bot_db_errors_total", "query", name)
+            raise
+        finally:
+            metrics.observe("bot_db_seconds", "query", name, perf_counter() - t0)
+    return wrapper
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest, который меряет каждый запрос к Bot API (метка — метод API)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        t0 = perf_counter()
+        code = 0
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            return code, payload
+        finally:
+            metrics.observe("bot_telegram_api_seconds", "method", endpoint, perf_counter() - t0)
+            if not 200 <= code < 300:
+                metrics.inc("bot_telegram_api_errors_total", "method", endpoint)
+
+async def watch_event_loop_lag(interval: float = 0.5) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - t0 - interval, 0.0)
+        metrics.set("bot_event_loop_lag_seconds", lag)
+
+class SamplingProfiler:
+    """
+    Семплирующий профайлер: отдельный поток раз в interval сек снимает стек потока
+    с event loop'ом (sys._current_frames) и считает одинаковые стеки.
+    Результат — "collapsed stacks" (формат flamegraph.pl / speedscope).
+    """
+
+    def __init__(self) -> None:
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Dict[str, int] = {}
+        self._target = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float = 0.005) -> None:
+        if self.running:
+            return
+        self._target = threading.get_ident()  # вызываем из потока event loop'а
+        self._stacks = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        if not self.running:
+            return ""
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return "\n".join(f"{stack} {n}" for stack, n in
+                         sorted(self._stacks.items(), key=lambda kv: -kv[1])) + "\n"
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self._stacks[key] = self._stacks.get(key, 0) + 1
+
+profiler = SamplingProfiler()
+
+async def _metrics_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # заголовки не нужны
+        path = request_line[1] if len(request_line) > 1 else "/"
+        path, _, query = path.partition("?")
+
+        status, body = "200 OK", ""
+        if path == "/metrics":
+            body = metrics.render()
+        elif path.startswith("/debug/profile/") and not PROFILER_ENABLED:
+            status, body = "403 Forbidden", "profiler disabled (set PROFILER_ENABLED=1)\n"
+        elif path == "/debug/profile/start":
+            params = urllib.parse.parse_qs(query)
+            profiler.start(float(params.get("interval", ["0.005"])[0]))
+            body = "profiler started\n"
+        elif path == "/debug/profile/stop":
+            body = profiler.stop() or "profiler is not running\n"
+        else:
+            status, body = "404 Not Found", "not found\n"
+
+        data = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + data
+        )
+        await writer.drain()
+    except Exception:
+        logger.exception("metrics request failed")
+    finally:
+        writer.close()
+
+async def start_metrics_server() -> Optional[asyncio.AbstractServer]:
+    if METRICS_PORT == 0:
+        return None
+    server = await asyncio.start_server(_metrics_http, METRICS_HOST, METRICS_PORT)
+    logger.info("metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return server
+
 
 # =========================
 # DB helpers
 # =========================
-def db_connect():
+# Один пул соединений на процесс: создаётся в on_startup(), закрывается в on_shutdown().
+# Хендлеры PTB асинхронные, поэтому и доступ к БД асинхронный — медленный запрос
+# не блокирует event loop и обработку апдейтов из других чатов.
+db_pool: Optional[AsyncConnectionPool] = None
+
+async def db_open(**connect_kwargs) -> AsyncConnectionPool:
+    """connect_kwargs — доп. аргументы psycopg.connect (например cursor_factory в bench.py)"""
+    global db_pool
     if not DATABASE_URL:
         raise RuntimeError("Set DATABASE_URL env var (Railway Postgres)")
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
-
-def init_db() -> None:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    solves INT NOT NULL DEFAULT 0,
-                    rank TEXT NOT NULL DEFAULT '🆕 Новичок',
-                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS queue_items (
-                    id SERIAL PRIMARY KEY,
-                    payload TEXT NOT NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT NOW()
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS challenges (
-                    id SERIAL PRIMARY KEY,
-                    chat_id BIGINT NOT NULL,
-                    thread_id BIGINT NOT NULL,
-                    message_id BIGINT,
-                    method TEXT NOT NULL,
-                    payload TEXT NOT NULL,
-                    encoded TEXT NOT NULL,
-                    answer TEXT NOT NULL,
-                    hint TEXT NOT NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                    is_active BOOLEAN NOT NULL DEFAULT TRUE
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS challenge_solves (
-                    challenge_id INT REFERENCES challenges(id) ON DELETE CASCADE,
-                    user_id BIGINT NOT NULL,
-                    solved_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                    PRIMARY KEY (challenge_id, user_id)
+    db_pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        kwargs={"row_factory": dict_row, **connect_kwargs},
+        open=False,
+    )
+    await db_pool.open(wait=True)
+    return db_pool
+
+async def db_close() -> None:
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+def db_connection():
+    """
+    Берёт соединение из пула (async context manager).
+    По выходу из блока транзакция коммитится (или откатывается при ошибке).
+    """
+    if db_pool is None:
+        raise RuntimeError("DB pool is not open (call db_open() first)")
+    return db_pool.connection()
+
+# Схема версионируется: в schema_version записаны применённые миграции.
+# Старт при актуальной схеме — один SELECT, без DDL.
+# Новая миграция — новая функция в конец MIGRATIONS (уже выпущенные не меняем).
+# Все миграции идемпотентны (IF NOT EXISTS): базы, заведённые до schema_version,
+# проходят их с версии 0 и обновляются на месте.
+
+async def _migration_baseline(cur) -> None:
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            solves INT NOT NULL DEFAULT 0,
+            rank TEXT NOT NULL DEFAULT '🆕 Новичок',
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS queue_items (
+            id SERIAL PRIMARY KEY,
+            payload TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS challenges (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            thread_id BIGINT NOT NULL,
+            message_id BIGINT,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            encoded TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            hint TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            is_active BOOLEAN NOT NULL DEFAULT TRUE
+        );
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS challenge_solves (
+            challenge_id INT REFERENCES challenges(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            solved_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (challenge_id, user_id)
+        );
+    """)
+
+async def _migration_user_attempts(cur) -> None:
+    await cur.execute("""
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS attempts BIGINT NOT NULL DEFAULT 0;
+    """)
+
+async def _migration_chat_queues(cur) -> None:
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            thread_id BIGINT NOT NULL DEFAULT 0,
+            post_time TIME NOT NULL DEFAULT '09:00',
+            methods TEXT[] NOT NULL DEFAULT '{}',
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            last_posted_on DATE
+        );
+    """)
+    # У каждого чата своя очередь. Старые задания (до мультичата) — чату по умолчанию.
+    await cur.execute("""
+        ALTER TABLE queue_items ADD COLUMN IF NOT EXISTS chat_id BIGINT NOT NULL DEFAULT 0;
+    """)
+    # Без TARGET_CHAT_ID старые задания остались бы под chat 0 навсегда (миграция второй раз
+    # не запускается) — падаем, весь апгрейд откатывается
+    await cur.execute("SELECT EXISTS (SELECT 1 FROM queue_items WHERE chat_id=0) AS legacy;")
+    if (await cur.fetchone())["legacy"] and not TARGET_CHAT_ID:
+        raise RuntimeError("Set TARGET_CHAT_ID env var: queued items from before per-chat queues need a chat")
+    await cur.execute("UPDATE queue_items SET chat_id=%s WHERE chat_id=0;", (TARGET_CHAT_ID,))
+    # Счётчики очередей вместо COUNT(*) по queue_items: их ведут запросы, меняющие очередь.
+    # Первичное заполнение (COUNT по чатам) — только пока таблица пустая.
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS queue_counters (
+            chat_id BIGINT PRIMARY KEY,
+            items BIGINT NOT NULL DEFAULT 0
+        );
+    """)
+    await cur.execute("""
+        INSERT INTO queue_counters (chat_id, items)
+        SELECT chat_id, COUNT(*) FROM queue_items
+        WHERE NOT EXISTS (SELECT 1 FROM queue_counters)
+        GROUP BY chat_id;
+    """)
+
+async def _migration_hot_path_indexes(cur) -> None:
+    # порядок лидерборда; в индекс попадают только те, кто что-то решил
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS users_leaderboard_idx
+        ON users (solves DESC, user_id)
+        WHERE solves > 0;
+    """)
+    # FIFO-выборка очереди чата (queue_pop_items)
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS queue_items_chat_idx ON queue_items (chat_id, id);
+    """)
+    # поиск активного задания чата/ветки
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS challenges_active_idx
+        ON challenges (chat_id, thread_id)
+        WHERE is_active;
+    """)
+    # "что из активного этот пользователь уже решил" (solved_challenges): PK начинается
+    # с challenge_id, поиск по user_id без этого индекса — seq scan по всем решениям
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS challenge_solves_user_idx
+        ON challenge_solves (user_id, challenge_id);
+    """)
+
+async def _migration_archive(cur) -> None:
+    # без внешних ключей и вторичных индексов: в архив только пишут пачками
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS challenges_archive (
+            id INT PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            thread_id BIGINT NOT NULL,
+            message_id BIGINT,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            encoded TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            hint TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS challenge_solves_archive (
+            challenge_id INT NOT NULL,
+            user_id BIGINT NOT NULL,
+            solved_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (challenge_id, user_id)
+        );
+    """)
+    # кандидаты на архивацию: неактивные по возрасту
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS challenges_inactive_idx
+        ON challenges (created_at)
+        WHERE NOT is_active;
+    """)
+
+async def _migration_queue_payload_hash(cur) -> None:
+    # дедупликация при импорте файлом: "есть ли уже такое задание в очереди чата"
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS queue_items_payload_md5_idx
+        ON queue_items (chat_id, md5(payload));
+    """)
+
+async def _migration_chat_difficulty(cur) -> None:
+    await cur.execute("""
+        ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS difficulty INT NOT NULL DEFAULT 1;
+    """)
+
+async def _migration_image_challenges(cur) -> None:
+    await cur.execute("""
+        ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS image BOOLEAN NOT NULL DEFAULT FALSE;
+    """)
+    # file_id картинки после первой загрузки: повторный пост — без рендера и без аплоада
+    await cur.execute("""
+        ALTER TABLE challenges ADD COLUMN IF NOT EXISTS image_file_id TEXT;
+    """)
+    # задания, подготовленные заранее (уже зашифрованы и отрендерены)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS prepared_challenges (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            encoded TEXT NOT NULL,
+            hint TEXT NOT NULL,
+            image BYTEA,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            claimed_at TIMESTAMP,
+            claimed_by TEXT
+        );
+    """)
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS prepared_challenges_chat_idx
+        ON prepared_challenges (chat_id, id)
+        WHERE claimed_at IS NULL;
+    """)
+
+async def _migration_prepared_messages(cur) -> None:
+    # готовый текст сообщения (или подпись к картинке); NULL — подготовлено до этой миграции
+    await cur.execute("""
+        ALTER TABLE prepared_challenges ADD COLUMN IF NOT EXISTS message TEXT;
+    """)
+
+EMPTY_SOLVE_TIME_HIST = sql.SQL("array_fill(0, ARRAY[{}])").format(sql.Literal(len(SOLVE_TIME_BUCKETS) + 1))
+
+def solve_bucket_sql(expr: sql.Composable) -> sql.Composed:
+    """Корзина (1-based) для времени решения expr сек: i — "≤ SOLVE_TIME_BUCKETS[i-1]", последняя — больше"""
+    whens = sql.SQL(" ").join(
+        sql.SQL("WHEN {} <= {} THEN {}").format(expr, sql.Literal(bound), sql.Literal(i))
+        for i, bound in enumerate(SOLVE_TIME_BUCKETS, 1)
+    )
+    return sql.SQL("CASE {} ELSE {} END").format(whens, sql.Literal(len(SOLVE_TIME_BUCKETS) + 1))
+
+async def _migration_stats_rollups(cur) -> None:
+    # Роллапы для /stats (по чату): ведутся инкрементально при посте (activate_prepared_challenge)
+    # и при решении (submit_answer); /stats читает только их, история не сканируется.
+    await cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS challenge_stats (
+            challenge_id INT PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            method TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            solves INT NOT NULL DEFAULT 0,
+            first_solve_seconds INT,
+            solve_time_hist INT[] NOT NULL DEFAULT {empty}
+        );
+    """).format(empty=EMPTY_SOLVE_TIME_HIST))
+    await cur.execute("""
+        CREATE INDEX IF NOT EXISTS challenge_stats_chat_idx ON challenge_stats (chat_id, challenge_id DESC);
+    """)
+    await cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS method_stats (
+            chat_id BIGINT NOT NULL,
+            method TEXT NOT NULL,
+            challenges INT NOT NULL DEFAULT 0,
+            solves INT NOT NULL DEFAULT 0,
+            first_solves INT NOT NULL DEFAULT 0,
+            first_solve_seconds_sum BIGINT NOT NULL DEFAULT 0,
+            solve_time_hist INT[] NOT NULL DEFAULT {empty},
+            PRIMARY KEY (chat_id, method)
+        );
+    """).format(empty=EMPTY_SOLVE_TIME_HIST))
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            chat_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            challenges INT NOT NULL DEFAULT 0,
+            solves INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, day)
+        );
+    """)
+    # Разовое заполнение из уже накопленной истории (вместе с архивом)
+    await cur.execute(sql.SQL("""
+        WITH all_challenges AS (
+            SELECT id, chat_id, method, created_at FROM challenges
+            UNION ALL
+            SELECT id, chat_id, method, created_at FROM challenges_archive
+        ),
+        all_solves AS (
+            SELECT s.challenge_id, EXTRACT(EPOCH FROM s.solved_at - c.created_at) AS seconds
+            FROM (
+                SELECT challenge_id, solved_at FROM challenge_solves
+                UNION ALL
+                SELECT challenge_id, solved_at FROM challenge_solves_archive
+            ) s
+            JOIN all_challenges c ON c.id = s.challenge_id
+        ),
+        per_bucket AS (
+            SELECT challenge_id, {bucket} AS bucket, COUNT(*) AS solves, MIN(seconds) AS first_seconds
+            FROM all_solves
+            GROUP BY 1, 2
+        )
+        INSERT INTO challenge_stats
+            (challenge_id, chat_id, method, created_at, solves, first_solve_seconds, solve_time_hist)
+        SELECT c.id, c.chat_id, c.method, c.created_at,
+               COALESCE(SUM(pb.solves), 0), MIN(pb.first_seconds)::int,
+               array_agg(COALESCE(pb.solves, 0)::int ORDER BY b.bucket)
+        FROM all_challenges c
+        CROSS JOIN generate_series(1, {buckets}) AS b(bucket)
+        LEFT JOIN per_bucket pb ON pb.challenge_id = c.id AND pb.bucket = b.bucket
+        GROUP BY c.id, c.chat_id, c.method, c.created_at
+        ON CONFLICT DO NOTHING;
+    """).format(
+        bucket=solve_bucket_sql(sql.SQL("seconds")),
+        buckets=sql.Literal(len(SOLVE_TIME_BUCKETS) + 1),
+    ))
+    await cur.execute("""
+        INSERT INTO method_stats
+            (chat_id, method, challenges, solves, first_solves, first_solve_seconds_sum, solve_time_hist)
+        SELECT cs.chat_id, cs.method, COUNT(*), SUM(cs.solves), COUNT(cs.first_solve_seconds),
+               COALESCE(SUM(cs.first_solve_seconds), 0),
+               ARRAY(
+                   SELECT SUM(h.v)::int
+                   FROM challenge_stats cs2, unnest(cs2.solve_time_hist) WITH ORDINALITY AS h(v, i)
+                   WHERE cs2.chat_id = cs.chat_id AND cs2.method = cs.method
+                   GROUP BY h.i
+                   ORDER BY h.i
+               )
+        FROM challenge_stats cs
+        GROUP BY cs.chat_id, cs.method
+        ON CONFLICT DO NOTHING;
+    """)
+    await cur.execute("""
+        INSERT INTO daily_stats (chat_id, day, challenges, solves)
+        SELECT chat_id, day, SUM(challenges), SUM(solves)
+        FROM (
+            SELECT chat_id, created_at::date AS day, 1 AS challenges, 0 AS solves FROM challenge_stats
+            UNION ALL
+            SELECT cs.chat_id, s.solved_at::date, 0, 1
+            FROM (
+                SELECT challenge_id, solved_at FROM challenge_solves
+                UNION ALL
+                SELECT challenge_id, solved_at FROM challenge_solves_archive
+            ) s
+            JOIN challenge_stats cs ON cs.challenge_id = s.challenge_id
+        ) d
+        GROUP BY chat_id, day
+        ON CONFLICT DO NOTHING;
+    """)
+
+MIGRATIONS = [
+    (1, "baseline tables", _migration_baseline),
+    (2, "users.attempts", _migration_user_attempts),
+    (3, "per-chat settings and queues", _migration_chat_queues),
+    (4, "hot-path indexes", _migration_hot_path_indexes),
+    (5, "challenge archive", _migration_archive),
+    (6, "queue payload hash index", _migration_queue_payload_hash),
+    (7, "chat difficulty", _migration_chat_difficulty),
+    (8, "image challenges", _migration_image_challenges),
+    (9, "prepared challenge messages", _migration_prepared_messages),
+    (10, "statistics rollups", _migration_stats_rollups),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def get_schema_version(conn) -> int:
+    try:
+        cur = await conn.execute("SELECT max(version) AS version FROM schema_version;")
+        row = await cur.fetchone()
+    except psycopg.errors.UndefinedTable:
+        await conn.rollback()
+        return 0
+    return row["version"] or 0
+
+@timed_db
+async def init_db() -> None:
+    async with db_connection() as conn:
+        version = await get_schema_version(conn)
+        await conn.commit()
+        if version >= SCHEMA_VERSION:
+            return
+
+        # Медленный путь — только на первом старте после обновления.
+        # Весь апгрейд — одна транзакция (DDL в Postgres транзакционный): упали — схема не тронута.
+        # Advisory lock: второй процесс ждёт, потом видит актуальную версию и ничего не делает.
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_KEY,))
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
                 );
             """)
-        conn.commit()
+            await cur.execute("SELECT COALESCE(max(version), 0) AS version FROM schema_version;")
+            version = (await cur.fetchone())["version"]
+            for number, description, migrate in MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info("applying schema migration %s: %s", number, description)
+                await migrate(cur)
+                await cur.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                    (number, description),
+                )
+        await conn.commit()
 
 def get_rank(solves: int) -> str:
     rank = RANKS[0][1]
@@ -114,204 +843,1497 @@ def get_rank(solves: int) -> str:
             break
     return rank
 
-def upsert_user(user_id: int, username: str, first_name: str) -> None:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO users (user_id, username, first_name)
-                VALUES (%s, %s, %s)
+@timed_db
+async def upsert_user(user_id: int, username: str, first_name: str) -> dict:
+    """
+    Создать пользователя или обновить username/first_name — только если они поменялись
+    (иначе строку не трогаем, updated_at тоже). returns: {"solves", "rank"}
+    """
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                WITH up AS (
+                    INSERT INTO users (user_id, username, first_name)
+                    VALUES (%(user_id)s, %(username)s, %(first_name)s)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        first_name = EXCLUDED.first_name,
+                        updated_at = NOW()
+                    WHERE users.username IS DISTINCT FROM EXCLUDED.username
+                       OR users.first_name IS DISTINCT FROM EXCLUDED.first_name
+                    RETURNING solves, rank
+                )
+                SELECT solves, rank FROM up
+                UNION ALL
+                SELECT solves, rank FROM users
+                WHERE user_id = %(user_id)s AND NOT EXISTS (SELECT 1 FROM up);
+            """, {"user_id": user_id, "username": username, "first_name": first_name})
+            row = await cur.fetchone()
+            if row is None:
+                # строку только что вставил параллельный запрос: ON CONFLICT её дождался, но
+                # снимок этого запроса её не видит — новый запрос (READ COMMITTED) уже увидит
+                await cur.execute("SELECT solves, rank FROM users WHERE user_id=%s;", (user_id,))
+                row = await cur.fetchone()
+        await conn.commit()
+    return row
+
+@timed_db
+async def add_attempts(counts: Dict[int, int]) -> None:
+    """users.attempts += n для пачки пользователей одним запросом"""
+    if not counts:
+        return
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO users AS u (user_id, attempts)
+                SELECT * FROM unnest(%s::bigint[], %s::bigint[])
                 ON CONFLICT (user_id) DO UPDATE SET
-                    username = EXCLUDED.username,
-                    first_name = EXCLUDED.first_name,
-                    updated_at = NOW();
-            """, (user_id, username, first_name))
-        conn.commit()
-
-def add_solve(user_id: int) -> Tuple[int, str, str]:
-    """
-    +1 solve, пересчитать ранг
-    returns: (new_solves, old_rank, new_rank)
-    """
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT solves, rank FROM users WHERE user_id=%s;", (user_id,))
-            row = cur.fetchone()
-            if not row:
-                # если вдруг нет — создадим с 0 и потом добавим
-                cur.execute("""
-                    INSERT INTO users (user_id, solves, rank)
-                    VALUES (%s, 0, %s)
-                    ON CONFLICT (user_id) DO NOTHING;
-                """, (user_id, get_rank(0)))
-                old_solves = 0
-                old_rank = get_rank(0)
-            else:
-                old_solves = int(row["solves"])
-                old_rank = row["rank"] or get_rank(old_solves)
-
-            new_solves = old_solves + 1
-            new_rank = get_rank(new_solves)
-
-            cur.execute("""
-                UPDATE users
-                SET solves=%s, rank=%s, updated_at=NOW()
-                WHERE user_id=%s;
-            """, (new_solves, new_rank, user_id))
-        conn.commit()
-
-    return new_solves, old_rank, new_rank
-
-def queue_push(payload: str) -> int:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("INSERT INTO queue_items (payload) VALUES (%s);", (payload,))
-            cur.execute("SELECT COUNT(*) AS c FROM queue_items;")
-            c = int(cur.fetchone()["c"])
-        conn.commit()
+                    attempts = u.attempts + EXCLUDED.attempts;
+            """, (list(counts.keys()), list(counts.values())))
+        await conn.commit()
+
+@timed_db
+async def get_leaderboard(limit: int = 10, offset: int = 0) -> List[dict]:
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT user_id, COALESCE(NULLIF(username, ''), first_name) AS name, solves, rank
+                FROM users
+                WHERE solves > 0
+                ORDER BY solves DESC, user_id
+                LIMIT %s OFFSET %s;
+            """, (limit, offset))
+            rows = await cur.fetchall()
+    return rows
+
+@timed_db
+async def get_stats(chat_id: int, recent: int = STATS_RECENT_CHALLENGES, days: int = STATS_DAYS) -> dict:
+    """Данные для /stats — только из роллапов (challenge_stats, method_stats, daily_stats)"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT challenge_id, method, created_at, solves, first_solve_seconds, solve_time_hist
+                FROM challenge_stats
+                WHERE chat_id = %s
+                ORDER BY challenge_id DESC
+                LIMIT %s;
+            """, (chat_id, recent))
+            challenges = await cur.fetchall()
+            await cur.execute("""
+                SELECT method, challenges, solves, first_solves, first_solve_seconds_sum, solve_time_hist
+                FROM method_stats
+                WHERE chat_id = %s
+                ORDER BY challenges DESC, method;
+            """, (chat_id,))
+            methods = await cur.fetchall()
+            await cur.execute("""
+                SELECT day, challenges, solves
+                FROM daily_stats
+                WHERE chat_id = %s AND day > CURRENT_DATE - %s::int
+                ORDER BY day DESC;
+            """, (chat_id, days))
+            daily = await cur.fetchall()
+    return {"challenges": challenges, "methods": methods, "daily": daily}
+
+@timed_db
+async def get_solves_histogram() -> Dict[int, int]:
+    """solves -> сколько пользователей с таким числом решений (только solves > 0)"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT solves, COUNT(*) AS n
+                FROM users
+                WHERE solves > 0
+                GROUP BY solves;
+            """)
+            rows = await cur.fetchall()
+    return {int(r["solves"]): int(r["n"]) for r in rows}
+
+@timed_db
+async def queue_push_many(chat_id: int, payloads: List[str]) -> int:
+    """Добавить пачку заданий в очередь чата одним запросом. returns: сколько стало в очереди"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                WITH ins AS (
+                    INSERT INTO queue_items (chat_id, payload)
+                    SELECT %(chat_id)s, unnest(%(payloads)s::text[])
+                    RETURNING 1
+                )
+                INSERT INTO queue_counters AS qc (chat_id, items)
+                VALUES (%(chat_id)s, (SELECT COUNT(*) FROM ins))
+                ON CONFLICT (chat_id) DO UPDATE SET items = qc.items + EXCLUDED.items
+                RETURNING items;
+            """, {"chat_id": chat_id, "payloads": payloads})
+            c = int((await cur.fetchone())["items"])
+        await conn.commit()
     return c
 
-def queue_count() -> int:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) AS c FROM queue_items;")
-            c = int(cur.fetchone()["c"])
-    return c
+# Импорт из файла: строки уже во временной таблице queue_import (COPY), здесь — дедупликация
+# (внутри файла и с тем, что уже в очереди чата) по md5 и вставка в исходном порядке.
+QUEUE_IMPORT_SQL = """
+    WITH fresh AS (
+        SELECT DISTINCT ON (md5(i.payload)) i.ord, i.payload
+        FROM queue_import i
+        WHERE NOT EXISTS (
+            SELECT 1 FROM queue_items q
+            WHERE q.chat_id = %(chat_id)s
+              AND md5(q.payload) = md5(i.payload)
+              AND q.payload = i.payload
+        )
+        ORDER BY md5(i.payload), i.ord
+    ),
+    ins AS (
+        INSERT INTO queue_items (chat_id, payload)
+        SELECT %(chat_id)s, payload FROM fresh ORDER BY ord
+        RETURNING 1
+    ),
+    counter AS (
+        INSERT INTO queue_counters AS qc (chat_id, items)
+        VALUES (%(chat_id)s, (SELECT COUNT(*) FROM ins))
+        ON CONFLICT (chat_id) DO UPDATE SET items = qc.items + EXCLUDED.items
+        RETURNING items
+    )
+    SELECT (SELECT COUNT(*) FROM ins) AS inserted, (SELECT items FROM counter) AS items;
+"""
 
-def queue_pop_fifo() -> Optional[str]:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT id, payload
-                FROM queue_items
-                ORDER BY id ASC
-                LIMIT 1;
+@timed_db
+async def queue_import(chat_id: int, payloads: Iterable[str]) -> Tuple[int, int, int]:
+    """
+    Залить в очередь чата поток заданий (COPY, без списка в памяти), пропуская дубли.
+    returns: (прочитано, добавлено, сколько стало в очереди)
+    """
+    total = 0
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                CREATE TEMP TABLE queue_import (
+                    ord BIGSERIAL,
+                    payload TEXT NOT NULL
+                ) ON COMMIT DROP;
             """)
-            row = cur.fetchone()
-            if not row:
-                return None
-            item_id = row["id"]
-            payload = row["payload"]
-            cur.execute("DELETE FROM queue_items WHERE id=%s;", (item_id,))
-        conn.commit()
-    return payload
-
-def deactivate_old_challenges(chat_id: int, thread_id: int) -> None:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE challenges
-                SET is_active=FALSE
-                WHERE chat_id=%s AND thread_id=%s AND is_active=TRUE;
-            """, (chat_id, thread_id))
-        conn.commit()
-
-def create_challenge(chat_id: int, thread_id: int, message_id: int,
-                     method: str, payload: str, encoded: str, answer: str, hint: str) -> int:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO challenges
-                    (chat_id, thread_id, message_id, method, payload, encoded, answer, hint, is_active)
-                VALUES
-                    (%s, %s, %s, %s, %s, %s, %s, %s, TRUE)
-                RETURNING id;
-            """, (chat_id, thread_id, message_id, method, payload, encoded, answer, hint))
-            cid = int(cur.fetchone()["id"])
-        conn.commit()
-    return cid
-
-def get_active_challenge() -> Optional[dict]:
-    if TARGET_CHAT_ID == 0 or MINI_CTF_THREAD_ID == 0:
+            async with cur.copy("COPY queue_import (payload) FROM STDIN") as copy:
+                for payload in payloads:
+                    await copy.write_row((payload,))
+                    total += 1
+            await cur.execute(QUEUE_IMPORT_SQL, {"chat_id": chat_id})
+            row = await cur.fetchone()
+        await conn.commit()
+    return total, int(row["inserted"]), int(row["items"])
+
+async def queue_push(chat_id: int, payload: str) -> int:
+    return await queue_push_many(chat_id, [payload])
+
+@timed_db
+async def queue_count(chat_id: int) -> int:
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT items FROM queue_counters WHERE chat_id=%s;", (chat_id,))
+            row = await cur.fetchone()
+    return max(int(row["items"]), 0) if row else 0
+
+@timed_db
+async def queue_pop_items(chat_id: int, limit: int) -> List[dict]:
+    """
+    Забрать до limit заданий из головы очереди чата (FIFO) одним запросом.
+    FOR UPDATE SKIP LOCKED: параллельные вызовы (несколько процессов) не получат одно и то же.
+    returns: [{"id", "payload"}] — id нужен, чтобы вернуть задание на место (queue_restore)
+    """
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                WITH picked AS (
+                    SELECT id
+                    FROM queue_items
+                    WHERE chat_id = %(chat_id)s
+                    ORDER BY id ASC
+                    LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
+                ),
+                popped AS (
+                    DELETE FROM queue_items q
+                    USING picked
+                    WHERE q.id = picked.id
+                    RETURNING q.id, q.payload
+                ),
+                counted AS (
+                    UPDATE queue_counters
+                    SET items = GREATEST(items - (SELECT COUNT(*) FROM popped), 0)
+                    WHERE chat_id = %(chat_id)s
+                )
+                SELECT id, payload FROM popped ORDER BY id ASC;
+            """, {"chat_id": chat_id, "limit": limit})
+            rows = await cur.fetchall()
+        await conn.commit()
+    return rows
+
+@timed_db
+async def queue_restore(chat_id: int, items: List[dict]) -> None:
+    """Вернуть забранные queue_pop_items задания с прежними id — на их места в очереди"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                WITH ins AS (
+                    INSERT INTO queue_items (id, chat_id, payload)
+                    SELECT unnest(%(ids)s::int[]), %(chat_id)s, unnest(%(payloads)s::text[])
+                    RETURNING 1
+                )
+                INSERT INTO queue_counters AS qc (chat_id, items)
+                VALUES (%(chat_id)s, (SELECT COUNT(*) FROM ins))
+                ON CONFLICT (chat_id) DO UPDATE SET items = qc.items + EXCLUDED.items;
+            """, {
+                "chat_id": chat_id,
+                "ids": [item["id"] for item in items],
+                "payloads": [item["payload"] for item in items],
+            })
+        await conn.commit()
+
+@timed_db
+async def chats_to_prepare(ahead: int) -> List[dict]:
+    """Включённые чаты, у которых готовых заданий меньше ahead (+ сколько уже готово)"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT cs.*, COUNT(p.id) AS prepared
+                FROM chat_settings cs
+                LEFT JOIN prepared_challenges p ON p.chat_id = cs.chat_id AND p.claimed_at IS NULL
+                WHERE cs.enabled
+                GROUP BY cs.chat_id
+                HAVING COUNT(p.id) < %s;
+            """, (ahead,))
+            rows = await cur.fetchall()
+    return rows
+
+@timed_db
+async def prepared_count(chat_id: int) -> int:
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT COUNT(*) AS n FROM prepared_challenges WHERE chat_id=%s AND claimed_at IS NULL;",
+                (chat_id,),
+            )
+            row = await cur.fetchone()
+    return int(row["n"])
+
+@timed_db
+async def save_prepared_challenges(chat_id: int, challenges: List[dict]) -> None:
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany("""
+                INSERT INTO prepared_challenges (chat_id, method, payload, encoded, hint, message, image)
+                VALUES (%(chat_id)s, %(method)s, %(payload)s, %(encoded)s, %(hint)s, %(message)s, %(image)s);
+            """, [{"chat_id": chat_id, **challenge} for challenge in challenges])
+        await conn.commit()
+
+# Активировать отправленное готовое задание (забрано claim_prepared_challenge): удалить его
+# из prepared, погасить старое активное, создать новое и завести его роллапы /stats — одним
+# запросом (новая строка в UPDATE не видна — она остаётся активной). Задание создаётся из
+# параметров: сообщение уже отправлено, даже если просроченную пометку успели снять.
+ACTIVATE_PREPARED_SQL = """
+    WITH claimed AS (
+        DELETE FROM prepared_challenges WHERE id = %(prepared_id)s
+    ),
+    used AS (
+        SELECT %(method)s::text AS method, %(payload)s::text AS payload,
+               %(encoded)s::text AS encoded, %(hint)s::text AS hint
+    ),
+    old AS (
+        UPDATE challenges SET is_active = FALSE
+        WHERE chat_id = %(chat_id)s AND thread_id = %(thread_id)s AND is_active
+    ),
+    created AS (
+        INSERT INTO challenges
+            (chat_id, thread_id, message_id, method, payload, encoded, answer, hint, image_file_id, is_active)
+        SELECT %(chat_id)s, %(thread_id)s, %(message_id)s, method, payload, encoded, payload, hint,
+               %(image_file_id)s, TRUE
+        FROM used
+        RETURNING *
+    ),
+    challenge_rollup AS (
+        INSERT INTO challenge_stats (challenge_id, chat_id, method, created_at)
+        SELECT id, chat_id, method, created_at FROM created
+    ),
+    method_rollup AS (
+        INSERT INTO method_stats AS ms (chat_id, method, challenges)
+        SELECT chat_id, method, 1 FROM created
+        ON CONFLICT (chat_id, method) DO UPDATE SET challenges = ms.challenges + 1
+    ),
+    daily_rollup AS (
+        INSERT INTO daily_stats AS ds (chat_id, day, challenges)
+        SELECT chat_id, created_at::date, 1 FROM created
+        ON CONFLICT (chat_id, day) DO UPDATE SET challenges = ds.challenges + 1
+    )
+    SELECT * FROM created;
+"""
+
+@timed_db
+async def claim_prepared_challenge(chat_id: int) -> Optional[dict]:
+    """
+    Пометить старейшее свободное готовое задание чата как забранное этим процессом
+    (короткая транзакция; SKIP LOCKED — не делим с другими). Удаляется оно при активации.
+    """
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                UPDATE prepared_challenges SET claimed_at = NOW(), claimed_by = %s
+                WHERE id = (
+                    SELECT id FROM prepared_challenges
+                    WHERE chat_id = %s AND claimed_at IS NULL
+                    ORDER BY id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *;
+            """, (INSTANCE_ID, chat_id))
+            row = await cur.fetchone()
+        await conn.commit()
+    return row
+
+@timed_db
+async def unclaim_prepared_challenge(prepared: dict) -> None:
+    """Снять пометку: задание снова свободно (и с прежним id — первое в очереди чата)"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                UPDATE prepared_challenges SET claimed_at = NULL, claimed_by = NULL
+                WHERE id = %s AND claimed_by = %s;
+            """, (prepared["id"], INSTANCE_ID))
+        await conn.commit()
+
+@timed_db
+async def release_stale_claims(timeout: float) -> int:
+    """Снять пометки старше timeout сек (процесс упал, не активировав задание); returns: сколько"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                UPDATE prepared_challenges SET claimed_at = NULL, claimed_by = NULL
+                WHERE claimed_at < NOW() - make_interval(secs => %s);
+            """, (timeout,))
+            released = cur.rowcount
+        await conn.commit()
+    return released
+
+@timed_db
+async def activate_challenge(chat_id: int, thread_id: int, prepared: dict,
+                             sent: Optional[Message]) -> dict:
+    """sent — отправленное сообщение; None — неизвестно, дошло ли (TimedOut): без message_id"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(ACTIVATE_PREPARED_SQL, {
+                "prepared_id": prepared["id"],
+                "method": prepared["method"],
+                "payload": prepared["payload"],
+                "encoded": prepared["encoded"],
+                "hint": prepared["hint"],
+                "chat_id": chat_id,
+                "thread_id": thread_id,
+                "message_id": sent.message_id if sent else None,
+                "image_file_id": sent.photo[-1].file_id if sent and sent.photo else None,
+            })
+            row = await cur.fetchone()
+            await notify_active_changed(cur, chat_id, thread_id)
+        await conn.commit()
+    active_challenges.put(chat_id, thread_id, row)
+    return row
+
+async def activate_prepared_challenge(chat_id: int, thread_id: int,
+                                      send: Callable[[dict], Awaitable[Message]]) -> Optional[dict]:
+    """
+    Забрать (пометить) старейшее готовое задание чата, отправить его через send(prepared),
+    активировать. Соединение из пула на время отправки (пейсинг outbox, RetryAfter) не держим.
+    Отправка упала — пометка снимается; процесс упал — её снимет prepare_job по таймауту. TimedOut — сообщение могло дойти
+    (outbox его не повторяет), поэтому активируем: иначе в группе висит незасчитываемое задание.
+    returns: новая строка challenges или None, если готовых заданий нет
+    """
+    prepared = await claim_prepared_challenge(chat_id)
+    if prepared is None:
         return None
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
+    try:
+        sent = await send(prepared)
+    except TimedOut:
+        logger.warning("chat %s: challenge send timed out, activating it anyway", chat_id)
+        sent = None
+    except BaseException:
+        await unclaim_prepared_challenge(prepared)
+        raise
+    return await activate_challenge(chat_id, thread_id, prepared, sent)
+
+@timed_db
+async def get_chat_settings(chat_id: int) -> Optional[dict]:
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT * FROM chat_settings WHERE chat_id=%s;", (chat_id,))
+            row = await cur.fetchone()
+    return row
+
+@timed_db
+async def setup_chat(chat_id: int, thread_id: int, skip_today: bool) -> dict:
+    """Завести чат (или сменить ветку). skip_today — сегодня уже не постить (время прошло)."""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO chat_settings AS cs (chat_id, thread_id, post_time, last_posted_on)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    thread_id = EXCLUDED.thread_id,
+                    enabled = TRUE
+                RETURNING *;
+            """, (chat_id, thread_id, DAILY_POST_TIME, date.today() if skip_today else None))
+            row = await cur.fetchone()
+        await conn.commit()
+    return row
+
+@timed_db
+async def update_chat_settings(chat_id: int, **fields) -> Optional[dict]:
+    assignments = sql.SQL(", ").join(
+        sql.SQL("{} = {}").format(sql.Identifier(name), sql.Placeholder(name)) for name in fields
+    )
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                sql.SQL("UPDATE chat_settings SET {} WHERE chat_id = %(chat_id)s RETURNING *;").format(assignments),
+                {**fields, "chat_id": chat_id},
+            )
+            row = await cur.fetchone()
+        await conn.commit()
+    return row
+
+@timed_db
+async def seed_default_chat() -> None:
+    """Чат из TARGET_CHAT_ID/MINI_CTF_THREAD_ID (как было до мультичата) — в chat_settings."""
+    if TARGET_CHAT_ID == 0 or MINI_CTF_THREAD_ID == 0:
+        return
+    # как run_daily раньше: если время поста уже прошло, первый пост — завтра
+    skip_today = date.today() if datetime.now().time() >= DAILY_POST_TIME else None
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO chat_settings (chat_id, thread_id, post_time, last_posted_on)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (chat_id) DO NOTHING;
+            """, (TARGET_CHAT_ID, MINI_CTF_THREAD_ID, DAILY_POST_TIME, skip_today))
+        await conn.commit()
+
+@timed_db
+async def claim_due_chats(now: time, today: date) -> List[dict]:
+    """
+    Чаты, которым сегодня пора постить и которые ещё не постили.
+    Сразу помечаем last_posted_on — повторный тик (или другой процесс) их не возьмёт.
+    """
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                UPDATE chat_settings
+                SET last_posted_on = %(today)s
+                WHERE enabled
+                  AND post_time <= %(now)s
+                  AND (last_posted_on IS NULL OR last_posted_on < %(today)s)
+                RETURNING *;
+            """, {"now": now, "today": today})
+            rows = await cur.fetchall()
+        await conn.commit()
+    return rows
+
+async def notify_active_changed(cur, chat_id: int, thread_id: int) -> None:
+    # NOTIFY доставляется после COMMIT — другие процессы перечитают уже новое состояние
+    await cur.execute(
+        "SELECT pg_notify(%s, %s);",
+        (ACTIVE_CHALLENGE_CHANNEL, f"{chat_id}:{thread_id}"),
+    )
+
+@timed_db
+async def fetch_active_challenge(chat_id: int, thread_id: int) -> Optional[dict]:
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
                 SELECT *
                 FROM challenges
                 WHERE chat_id=%s AND thread_id=%s AND is_active=TRUE
                 ORDER BY id DESC
                 LIMIT 1;
-            """, (TARGET_CHAT_ID, MINI_CTF_THREAD_ID))
-            row = cur.fetchone()
+            """, (chat_id, thread_id))
+            row = await cur.fetchone()
     return row
 
-def has_solved(challenge_id: int, user_id: int) -> bool:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT 1 FROM challenge_solves
-                WHERE challenge_id=%s AND user_id=%s
-                LIMIT 1;
-            """, (challenge_id, user_id))
-            row = cur.fetchone()
-    return bool(row)
+@timed_db
+async def fetch_all_active_challenges() -> List[dict]:
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT DISTINCT ON (chat_id, thread_id) *
+                FROM challenges
+                WHERE is_active=TRUE
+                ORDER BY chat_id, thread_id, id DESC;
+            """)
+            rows = await cur.fetchall()
+    return rows
+
+async def get_active_challenge(chat_id: int, thread_id: int) -> Optional[dict]:
+    hit, row = active_challenges.get(chat_id, thread_id)
+    if hit:
+        return row
+    row = await fetch_active_challenge(chat_id, thread_id)
+    active_challenges.put(chat_id, thread_id, row)
+    return row
 
-def mark_solved(challenge_id: int, user_id: int) -> None:
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO challenge_solves (challenge_id, user_id)
-                VALUES (%s, %s)
-                ON CONFLICT DO NOTHING;
-            """, (challenge_id, user_id))
-        conn.commit()
+async def get_active_challenges() -> List[dict]:
+    """Активные задания всех чатов (из кеша; если кеш сброшен — прогреваем)."""
+    if not active_challenges.loaded:
+        await warm_active_challenges()
+    return active_challenges.active()
+
+@timed_db
+async def solved_challenges(user_id: int, challenge_ids: List[int]) -> set:
+    """Какие из challenge_ids пользователь уже решил"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT challenge_id FROM challenge_solves
+                WHERE user_id=%s AND challenge_id = ANY(%s);
+            """, (user_id, challenge_ids))
+            rows = await cur.fetchall()
+    return {int(r["challenge_id"]) for r in rows}
+
+def rank_case_sql(expr: sql.Composable) -> sql.Composed:
+    """SQL-версия get_rank(): CASE по порогам RANKS для выражения expr."""
+    whens = sql.SQL(" ").join(
+        sql.SQL("WHEN {} >= {} THEN {}").format(expr, sql.Literal(threshold), sql.Literal(name))
+        for threshold, name in reversed(RANKS)
+    )
+    return sql.SQL("CASE {} ELSE {} END").format(whens, sql.Literal(RANKS[0][1]))
+
+# Засчитать решение одним запросом: отметка в challenge_solves, +1 solve и новый ранг.
+# Если решение уже было (PK challenge_solves), INSERT ничего не вернёт и users не трогаем —
+# два одновременных верных ответа одного юзера не дадут двойной +1.
+# Тем же запросом обновляем роллапы /stats (задание; метод и день — в разрезе чата): время решения
+# в корзину гистограммы; "первое решение" — если у задания стало solves = 1.
+SUBMIT_ANSWER_SQL = sql.SQL("""
+    WITH solved AS (
+        INSERT INTO challenge_solves (challenge_id, user_id)
+        VALUES (%(challenge_id)s, %(user_id)s)
+        ON CONFLICT DO NOTHING
+        RETURNING user_id, solved_at
+    ),
+    prev AS (
+        SELECT rank FROM users WHERE user_id = %(user_id)s
+    ),
+    timing AS (
+        SELECT c.challenge_id, c.chat_id, c.method, s.solved_at,
+               EXTRACT(EPOCH FROM s.solved_at - c.created_at)::int AS seconds,
+               {bucket} AS bucket
+        FROM solved s
+        JOIN challenge_stats c ON c.challenge_id = %(challenge_id)s
+    ),
+    challenge_rollup AS (
+        UPDATE challenge_stats cs SET
+            solves = cs.solves + 1,
+            first_solve_seconds = COALESCE(cs.first_solve_seconds, t.seconds),
+            solve_time_hist[t.bucket] = cs.solve_time_hist[t.bucket] + 1
+        FROM timing t
+        WHERE cs.challenge_id = t.challenge_id
+        RETURNING cs.solves
+    ),
+    method_rollup AS (
+        UPDATE method_stats ms SET
+            solves = ms.solves + 1,
+            first_solves = ms.first_solves + CASE WHEN cr.solves = 1 THEN 1 ELSE 0 END,
+            first_solve_seconds_sum = ms.first_solve_seconds_sum + CASE WHEN cr.solves = 1 THEN t.seconds ELSE 0 END,
+            solve_time_hist[t.bucket] = ms.solve_time_hist[t.bucket] + 1
+        FROM timing t, challenge_rollup cr
+        WHERE ms.chat_id = t.chat_id AND ms.method = t.method
+    ),
+    daily_rollup AS (
+        INSERT INTO daily_stats AS ds (chat_id, day, solves)
+        SELECT chat_id, solved_at::date, 1 FROM timing
+        ON CONFLICT (chat_id, day) DO UPDATE SET solves = ds.solves + 1
+    )
+    INSERT INTO users AS u (user_id, username, first_name, solves, rank)
+    SELECT user_id, %(username)s, %(first_name)s, 1, {first_rank}
+    FROM solved
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        solves = u.solves + 1,
+        rank = {next_rank},
+        updated_at = NOW()
+    RETURNING u.solves, u.rank, (SELECT rank FROM prev) AS old_rank;
+""").format(
+    first_rank=sql.Literal(get_rank(1)),
+    next_rank=rank_case_sql(sql.SQL("u.solves + 1")),
+    bucket=solve_bucket_sql(sql.SQL("EXTRACT(EPOCH FROM s.solved_at - c.created_at)")),
+)
+
+@timed_db
+async def submit_answer(challenge_id: int, user_id: int,
+                        username: str, first_name: str) -> Optional[Tuple[int, str, str]]:
+    """
+    Верный ответ: отметить решение, +1 solve, пересчитать ранг (атомарно, один запрос)
+    returns: (new_solves, old_rank, new_rank) или None, если задание уже было решено
+    """
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(SUBMIT_ANSWER_SQL, {
+                "challenge_id": challenge_id,
+                "user_id": user_id,
+                "username": username,
+                "first_name": first_name,
+            })
+            row = await cur.fetchone()
+        await conn.commit()
+
+    if not row:
+        user_cache.mark_solved(user_id, challenge_id)
+        return None
+    new_solves = int(row["solves"])
+    old_rank = row["old_rank"] or get_rank(new_solves - 1)
+    leaderboard.on_solve(user_id, username or first_name, new_solves, row["rank"])
+    user_cache.put(user_id, username, first_name, new_solves, row["rank"], keep_solved=True)
+    user_cache.mark_solved(user_id, challenge_id)
+    return new_solves, old_rank, row["rank"]
+
+# Одна пачка архивации — один запрос: решения и сами задания удаляются из горячих таблиц
+# и вставляются в архив. SKIP LOCKED — пачку не задерживает чужая транзакция.
+ARCHIVE_BATCH_SQL = """
+    WITH batch AS (
+        SELECT id FROM challenges
+        WHERE NOT is_active
+          AND created_at < NOW() - make_interval(days => %(days)s)
+        ORDER BY created_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    moved_solves AS (
+        DELETE FROM challenge_solves s
+        USING batch
+        WHERE s.challenge_id = batch.id
+        RETURNING s.challenge_id, s.user_id, s.solved_at
+    ),
+    archived_solves AS (
+        INSERT INTO challenge_solves_archive (challenge_id, user_id, solved_at)
+        SELECT challenge_id, user_id, solved_at FROM moved_solves
+        ON CONFLICT DO NOTHING
+    ),
+    moved AS (
+        DELETE FROM challenges c
+        USING batch
+        WHERE c.id = batch.id
+        RETURNING c.id, c.chat_id, c.thread_id, c.message_id, c.method, c.payload,
+                  c.encoded, c.answer, c.hint, c.created_at
+    ),
+    archived AS (
+        INSERT INTO challenges_archive
+            (id, chat_id, thread_id, message_id, method, payload, encoded, answer, hint, created_at)
+        SELECT * FROM moved
+        ON CONFLICT DO NOTHING
+    )
+    SELECT (SELECT COUNT(*) FROM moved) AS challenges,
+           (SELECT COUNT(*) FROM moved_solves) AS solves;
+"""
+
+@timed_db
+async def archive_challenges_batch(days: int, limit: int) -> Tuple[int, int]:
+    """returns: (сколько заданий, сколько решений перенесено в архив)"""
+    async with db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(ARCHIVE_BATCH_SQL, {"days": days, "limit": limit})
+            row = await cur.fetchone()
+        await conn.commit()
+    return int(row["challenges"]), int(row["solves"])
 
 
 # =========================
-# CIPHERS
+# ACTIVE CHALLENGE CACHE
+# =========================
+class ActiveChallengeCache:
+    """
+    Активные задания в памяти процесса: (chat_id, thread_id) -> строка challenges.
+    В строку добавлен answer_norm (normalize(answer)), чтобы не считать его на каждый ответ.
+    None в кеше — "активного задания нет" (тоже ответ, без похода в БД).
+    """
+
+    def __init__(self) -> None:
+        self._items: Dict[Tuple[int, int], Optional[dict]] = {}
+        self.loaded = False  # в кеше все активные задания (после replace_all)
+
+    def get(self, chat_id: int, thread_id: int) -> Tuple[bool, Optional[dict]]:
+        key = (chat_id, thread_id)
+        if key not in self._items:
+            return False, None
+        return True, self._items[key]
+
+    @staticmethod
+    def _prepare(row: Optional[dict]) -> Optional[dict]:
+        if row is None:
+            return None
+        row = dict(row)
+        row["answer_norm"] = normalize(row["answer"] or "")
+        return row
+
+    def put(self, chat_id: int, thread_id: int, row: Optional[dict]) -> None:
+        # замена одним присваиванием — читатели видят либо старое задание, либо новое
+        self._items[(chat_id, thread_id)] = self._prepare(row)
+
+    def replace_all(self, rows: List[dict], empty_keys: List[Tuple[int, int]]) -> None:
+        """Полная перезагрузка: rows — все активные задания, empty_keys — чаты, где их нет."""
+        items: Dict[Tuple[int, int], Optional[dict]] = {key: None for key in empty_keys}
+        for row in rows:
+            items[(int(row["chat_id"]), int(row["thread_id"]))] = self._prepare(row)
+        self._items = items
+        self.loaded = True
+
+    def active(self) -> List[dict]:
+        return [row for row in self._items.values() if row is not None]
+
+    def invalidate(self) -> None:
+        self._items = {}
+        self.loaded = False
+
+active_challenges = ActiveChallengeCache()
+
+async def warm_active_challenges() -> None:
+    rows = await fetch_all_active_challenges()
+    empty_keys = []
+    if TARGET_CHAT_ID != 0 and MINI_CTF_THREAD_ID != 0:
+        empty_keys.append((TARGET_CHAT_ID, MINI_CTF_THREAD_ID))
+    active_challenges.replace_all(rows, empty_keys)
+
+async def listen_active_challenges() -> None:
+    """
+    Фоновая задача: слушаем NOTIFY от других процессов (и от себя) и перечитываем
+    активное задание для указанного чата. После переподключения — полный прогрев,
+    т.к. уведомления за время обрыва потеряны.
+    """
+    delay = 1.0
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {ACTIVE_CHALLENGE_CHANNEL};")
+                await warm_active_challenges()
+                delay = 1.0
+                async for note in conn.notifies():
+                    chat_id, thread_id = (int(x) for x in note.payload.split(":"))
+                    row = await fetch_active_challenge(chat_id, thread_id)
+                    active_challenges.put(chat_id, thread_id, row)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("active challenge listener failed, reconnecting in %.0fs", delay)
+            active_challenges.invalidate()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+
 # =========================
-def caesar_encode(text: str, shift: int) -> str:
-    def shift_char(c: str) -> str:
-        if c.isalpha():
-            idx = ALPHABET.find(c.lower())
-            if idx == -1:
-                return c
-            new = ALPHABET[(idx + shift) % 26]
-            return new.upper() if c.isupper() else new
-        return c
-    return "".join(shift_char(c) for c in text)
+# LEADER ELECTION
+# =========================
+class LeaderElection:
+    """
+    Лидер — процесс, который держит pg_advisory_lock(key) на отдельном соединении.
+    Лидер раз в interval сек пингует соединение; не лидер — пытается забрать lock.
+    idle_session_timeout на этом соединении: если лидер "завис" без сети, Postgres
+    сам закроет его сессию и отпустит lock.
+    """
 
-def rot13(text: str) -> str:
-    return caesar_encode(text, 13)
+    def __init__(self, key: int, interval: float) -> None:
+        self.key = key
+        self.interval = interval
+        self.is_leader = False
+        self._conn: Optional[psycopg.AsyncConnection] = None
+
+    async def _connect(self) -> psycopg.AsyncConnection:
+        conn = await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True)
+        try:
+            await conn.execute(f"SET idle_session_timeout = '{int(self.interval * 3)}s';")
+        except psycopg.Error:
+            pass  # Postgres < 14
+        return conn
+
+    async def _tick(self) -> None:
+        if self._conn is None or self._conn.closed:
+            self._set_leader(False)
+            self._conn = await self._connect()
+        if self.is_leader:
+            await self._conn.execute("SELECT 1;")
+        else:
+            cur = await self._conn.execute("SELECT pg_try_advisory_lock(%s);", (self.key,))
+            self._set_leader(bool((await cur.fetchone())[0]))
+
+    def _set_leader(self, value: bool) -> None:
+        if value != self.is_leader:
+            logger.info("leader election: this process is %s", "LEADER" if value else "a follower")
+        self.is_leader = value
+        metrics.set("bot_is_leader", int(value))
+
+    async def _drop_connection(self) -> None:
+        self._set_leader(False)
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def confirm(self) -> bool:
+        """Проверить лидерство прямо сейчас (перед плановой работой)."""
+        if not self.is_leader:
+            return False
+        try:
+            await self._conn.execute("SELECT 1;")
+        except Exception:
+            logger.exception("leader connection is lost")
+            await self._drop_connection()
+        return self.is_leader
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("leader election failed")
+                await self._drop_connection()
+            await asyncio.sleep(self.interval)
 
-def b64_encode(text: str) -> str:
-    return base64.b64encode(text.encode("utf-8")).decode("ascii")
+    async def close(self) -> None:
+        # закрытие сессии отпускает advisory lock
+        await self._drop_connection()
 
-def hex_encode(text: str) -> str:
-    return binascii.hexlify(text.encode("utf-8")).decode("ascii")
+leader = LeaderElection(LEADER_LOCK_KEY, LEADER_CHECK_INTERVAL)
 
-def url_encode(text: str) -> str:
-    # Важно: percent-encoding. Такой вывод ты хотел (как %2F%3A...)
-    return "".join(f"%{b:02X}" for b in text.encode("utf-8"))
 
-def xor_encode(text: str, key: bytes) -> str:
-    data = text.encode("utf-8")
-    out = bytes([b ^ key[i % len(key)] for i, b in enumerate(data)])
-    return base64.b64encode(out).decode("ascii")
+# =========================
+# USER CACHE
+# =========================
+class UserCache:
+    """
+    LRU-кеш users: user_id -> {username, first_name, solves, rank, loaded_at, solved}.
+    Пишем в БД только когда поменялись username/first_name; submit_answer() обновляет
+    solves/rank здесь же (write-through). solves/rank старше USER_CACHE_TTL перечитываем.
+    solved — {challenge_id: решено ли} по активным заданиям, которые уже проверяли.
+    """
 
-def reverse(text: str) -> str:
-    return text[::-1]
+    def __init__(self, size: int, ttl: float) -> None:
+        self.size = size
+        self.ttl = ttl
+        self._items: "OrderedDict[int, dict]" = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[dict]:
+        entry = self._items.get(user_id)
+        if entry is not None:
+            self._items.move_to_end(user_id)
+        return entry
+
+    def put(self, user_id: int, username: str, first_name: str, solves: int, rank: str,
+            keep_solved: bool = False) -> dict:
+        old = self._items.get(user_id)
+        entry = {
+            "username": username,
+            "first_name": first_name,
+            "solves": solves,
+            "rank": rank,
+            "loaded_at": monotonic(),
+            "solved": old["solved"] if keep_solved and old is not None else {},
+        }
+        self._items[user_id] = entry
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+        return entry
+
+    def mark_solved(self, user_id: int, challenge_id: int) -> None:
+        entry = self._items.get(user_id)
+        if entry is not None:
+            entry["solved"][challenge_id] = True
+
+    def fresh(self, entry: dict) -> bool:
+        return monotonic() - entry["loaded_at"] < self.ttl
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+async def remember_user(user_id: int, username: str, first_name: str) -> dict:
+    """upsert_user() через кеш: если ничего не поменялось и данные свежие — без БД."""
+    entry = user_cache.get(user_id)
+    if (entry is not None and user_cache.fresh(entry)
+            and entry["username"] == username and entry["first_name"] == first_name):
+        return entry
+    row = await upsert_user(user_id, username, first_name)
+    return user_cache.put(user_id, username, first_name, int(row["solves"]), row["rank"])
+
+async def user_solved(entry: dict, user_id: int, challenge_ids: List[int]) -> set:
+    """
+    solved_challenges() через кеш (entry — из remember_user): про каждое задание в БД
+    спрашиваем один раз, дальше неверные ответы — без запросов
+    """
+    known = entry["solved"]
+    missing = [cid for cid in challenge_ids if cid not in known]
+    if missing:
+        solved = await solved_challenges(user_id, missing)
+        for cid in missing:
+            known[cid] = cid in solved
+    # погасшие задания не копим
+    entry["solved"] = {cid: known[cid] for cid in challenge_ids}
+    return {cid for cid in challenge_ids if known[cid]}
 
-def encode_text(method: str, text: str) -> Tuple[str, str]:
-    method = method.lower()
 
+# =========================
+# LEADERBOARD
+# =========================
+class Leaderboard:
+    """
+    Лидерборд в памяти:
+      - top: первые LEADERBOARD_TOP_N мест, отсортированы по (-solves, user_id) — как в SQL;
+      - hist: solves -> число пользователей, по нему место юзера считается без запросов к БД.
+    solves только растут, поэтому submit_answer() обновляет оба инкрементально (on_solve).
+    Раз в LEADERBOARD_TTL сек всё перечитывается — подхватить решения из других процессов.
+    """
+
+    def __init__(self, top_n: int, ttl: float) -> None:
+        self.top_n = top_n
+        self.ttl = ttl
+        self._top: List[dict] = []
+        self._keys: List[Tuple[int, int]] = []
+        self._hist: Dict[int, int] = {}
+        self._total = 0
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(solves: int, user_id: int) -> Tuple[int, int]:
+        return -solves, user_id
+
+    async def ensure_loaded(self) -> None:
+        if self._loaded_at is not None and monotonic() - self._loaded_at < self.ttl:
+            return
+        async with self._lock:
+            if self._loaded_at is not None and monotonic() - self._loaded_at < self.ttl:
+                return
+            top = await get_leaderboard(self.top_n)
+            hist = await get_solves_histogram()
+            self._top = [dict(r) for r in top]
+            self._keys = [self._key(int(r["solves"]), int(r["user_id"])) for r in self._top]
+            self._hist = hist
+            self._total = sum(hist.values())
+            self._loaded_at = monotonic()
+
+    def on_solve(self, user_id: int, name: str, solves: int, rank: str) -> None:
+        if self._loaded_at is None:
+            return
+
+        prev = solves - 1
+        if prev > 0:
+            self._hist[prev] = self._hist.get(prev, 0) - 1
+            if self._hist[prev] <= 0:
+                del self._hist[prev]
+        else:
+            self._total += 1
+        self._hist[solves] = self._hist.get(solves, 0) + 1
+
+        for i, entry in enumerate(self._top):
+            if int(entry["user_id"]) == user_id:
+                del self._top[i]
+                del self._keys[i]
+                break
+        key = self._key(solves, user_id)
+        if len(self._top) >= self.top_n and key > self._keys[-1]:
+            return
+        i = bisect.bisect_left(self._keys, key)
+        self._keys.insert(i, key)
+        self._top.insert(i, {"user_id": user_id, "name": name, "solves": solves, "rank": rank})
+        del self._keys[self.top_n:]
+        del self._top[self.top_n:]
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    async def page(self, page: int, size: int) -> List[dict]:
+        await self.ensure_loaded()
+        start = (page - 1) * size
+        # в памяти весь список, если он короче top_n, иначе только первые top_n мест
+        if start + size <= len(self._top) or len(self._top) < self.top_n:
+            return self._top[start:start + size]
+        return await get_leaderboard(size, start)
+
+    async def position(self, solves: int) -> Tuple[int, int]:
+        """returns: (место, всего участников) для пользователя с solves > 0"""
+        await self.ensure_loaded()
+        above = sum(n for s, n in self._hist.items() if s > solves)
+        return above + 1, self._total
+
+leaderboard = Leaderboard(LEADERBOARD_TOP_N, LEADERBOARD_TTL)
+
+
+# =========================
+# OUTBOX (исходящие сообщения)
+# =========================
+PRIORITY_GROUP = 0  # посты в группу (post_challenge) уходят первыми
+PRIORITY_DM = 1     # ответы в личку
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до появления токена (0 — можно сейчас)."""
+        self._refill(monotonic())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> bool:
+        if self.delay() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    @property
+    def full(self) -> bool:
+        self._refill(monotonic())
+        return self.tokens >= self.capacity
+
+class OutMessage:
+    __slots__ = ("chat_id", "text", "kwargs", "priority", "seq", "futures")
+
+    def __init__(self, chat_id: int, text: str, kwargs: dict, priority: int, seq: int,
+                 future: asyncio.Future) -> None:
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.futures = [future]
+
+class Outbox:
+    """
+    Очередь исходящих сообщений (photo=... в kwargs — фото, text уходит подписью):
+      - приоритеты (группа раньше личек), внутри приоритета — FIFO;
+      - token bucket глобально и на каждый чат, в один чат — строго по порядку;
+      - подряд идущие сообщения в один чат (одинаковые параметры) склеиваются в одно;
+      - RetryAfter (flood wait) и сетевые ошибки — повтор с ожиданием/backoff.
+    submit() возвращает future с отправленным Message; ждать его не обязательно.
+    """
+
+    def __init__(self) -> None:
+        self._bot: Optional[Bot] = None
+        self._pending: Dict[int, Deque[OutMessage]] = {}
+        self._ready: List[Tuple[int, int, int]] = []  # (priority, seq, chat_id)
+        self._scheduled: set = set()                   # чаты в _ready или в отложенном запуске
+        self._in_flight: set = set()
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._seq = 0
+        self._size = 0
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+    # --- API ---
+    def submit(self, chat_id: int, text: str, *, priority: int = PRIORITY_DM, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_future_exception)
+        self._seq += 1
+        self._pending.setdefault(chat_id, deque()).append(
+            OutMessage(chat_id, text, kwargs, priority, self._seq, future)
+        )
+        self._size += 1
+        metrics.set("bot_outbox_pending", self._size)
+        self._schedule(chat_id)
+        return future
+
+    async def send(self, chat_id: int, text: str, *, priority: int = PRIORITY_DM, **kwargs) -> Message:
+        return await self.submit(chat_id, text, priority=priority, **kwargs)
+
+    def start(self, bot: Bot, workers: int = OUTBOX_WORKERS) -> None:
+        self._bot = bot
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(workers)]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дожидаемся отправки хвоста (не дольше timeout), потом гасим воркеров."""
+        deadline = monotonic() + timeout
+        while (self._size or self._in_flight) and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    # --- планирование ---
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = OUTBOX_PRIVATE_RATE if chat_id > 0 else OUTBOX_GROUP_RATE
+            bucket = self._buckets[chat_id] = TokenBucket(rate, 2)
+        return bucket
+
+    def _schedule(self, chat_id: int) -> None:
+        if chat_id in self._scheduled or chat_id in self._in_flight or not self._pending.get(chat_id):
+            return
+        head = self._pending[chat_id][0]
+        self._scheduled.add(chat_id)
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    def _reschedule_later(self, chat_id: int, delay: float) -> None:
+        def push() -> None:
+            self._scheduled.discard(chat_id)
+            self._schedule(chat_id)
+        asyncio.get_running_loop().call_later(delay, push)
+
+    async def _next_chat(self) -> int:
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            _, _, chat_id = heapq.heappop(self._ready)
+            delay = self._bucket(chat_id).delay()
+            if delay > 0:
+                # чат упёрся в свой лимит — не держим остальных, вернём его в очередь позже
+                self._reschedule_later(chat_id, delay)
+                continue
+            while (delay := self._global.delay()) > 0:
+                await asyncio.sleep(delay)
+            self._global.take()
+            self._bucket(chat_id).take()
+            self._scheduled.discard(chat_id)
+            self._in_flight.add(chat_id)
+            return chat_id
+
+    def _take_batch(self, chat_id: int) -> OutMessage:
+        queue = self._pending[chat_id]
+        batch = queue.popleft()
+        # фото (text — подпись) не склеиваем ни с чем
+        while queue and "photo" not in batch.kwargs:
+            nxt = queue[0]
+            if (nxt.priority != batch.priority or nxt.kwargs != batch.kwargs
+                    or len(batch.text) + 2 + len(nxt.text) > TELEGRAM_MAX_TEXT):
+                break
+            queue.popleft()
+            batch.text += "\n\n" + nxt.text
+            batch.futures.extend(nxt.futures)
+        return batch
+
+    # --- отправка ---
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._next_chat()
+            batch = self._take_batch(chat_id)
+            try:
+                await self._deliver(batch)
+            except Exception as e:
+                logger.exception("outbox: failed to send to %s", chat_id)
+                for future in batch.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                self._size -= len(batch.futures)
+                metrics.set("bot_outbox_pending", self._size)
+                self._in_flight.discard(chat_id)
+                if not self._pending.get(chat_id):
+                    self._pending.pop(chat_id, None)
+                    if self._buckets.get(chat_id) is not None and self._buckets[chat_id].full:
+                        del self._buckets[chat_id]
+                self._schedule(chat_id)
+
+    async def _deliver(self, batch: OutMessage) -> None:
+        for attempt in range(OUTBOX_MAX_RETRIES):
+            last = attempt == OUTBOX_MAX_RETRIES - 1
+            try:
+                if "photo" in batch.kwargs:
+                    sent = await self._bot.send_photo(chat_id=batch.chat_id, caption=batch.text, **batch.kwargs)
+                else:
+                    sent = await self._bot.send_message(chat_id=batch.chat_id, text=batch.text, **batch.kwargs)
+            except RetryAfter as e:
+                if last:
+                    raise
+                metrics.inc("bot_outbox_retries_total", "reason", "retry_after")
+                await asyncio.sleep(float(e.retry_after))
+                continue
+            except TimedOut:
+                raise  # сообщение могло дойти — не дублируем
+            except BadRequest:
+                raise  # разметка, нет чата/ветки — повтор не поможет
+            except NetworkError:
+                if last:
+                    raise  # попытки кончились — наверх настоящую причину
+                metrics.inc("bot_outbox_retries_total", "reason", "network")
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 30.0))
+                continue
+            for future in batch.futures:
+                if not future.done():
+                    future.set_result(sent)
+            return
+
+def _consume_future_exception(future: asyncio.Future) -> None:
+    # submit() часто не ждут — ошибка уже залогирована воркером, не ругаемся "never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+outbox = Outbox()
+
+
+# =========================
+# ANSWER RATE LIMIT
+# =========================
+class _UserLimit:
+    __slots__ = ("bucket", "blocked_until", "strikes", "last_block")
+
+    def __init__(self) -> None:
+        self.bucket = TokenBucket(ANSWER_RATE, ANSWER_BURST)
+        self.blocked_until = 0.0
+        self.strikes = 0
+        self.last_block = 0.0
+
+class AnswerLimiter:
+    """
+    Ограничение попыток ответа на пользователя — целиком в памяти, до любых запросов к БД.
+    check() возвращает ALLOW (проверяем ответ), NOTIFY (лимит — один раз за кулдаун
+    ответить пользователю) или DROP (молча игнорируем).
+    """
+    ALLOW, NOTIFY, DROP = range(3)
+
+    def __init__(self) -> None:
+        self._state: Dict[int, _UserLimit] = {}
+        self._attempts: Dict[int, int] = {}
+
+    def check(self, user_id: int) -> Tuple[int, float]:
+        """returns: (вердикт, сколько секунд осталось до конца кулдауна)"""
+        self._attempts[user_id] = self._attempts.get(user_id, 0) + 1
+        st = self._state.get(user_id)
+        if st is None:
+            st = self._state[user_id] = _UserLimit()
+
+        now = monotonic()
+        if now < st.blocked_until:
+            # о кулдауне уже сообщили, когда он начался
+            return self.DROP, st.blocked_until - now
+        if st.bucket.take():
+            return self.ALLOW, 0.0
+
+        # ведро пустое — кулдаун, каждый следующий вдвое длиннее; долго вёл себя хорошо — прощаем
+        if now - st.last_block > ANSWER_COOLDOWN_MAX * 2:
+            st.strikes = 0
+        cooldown = min(ANSWER_COOLDOWN * 2 ** st.strikes, ANSWER_COOLDOWN_MAX)
+        st.strikes += 1
+        st.blocked_until = now + cooldown
+        st.last_block = now
+        return self.NOTIFY, cooldown
+
+    def drain_attempts(self) -> Dict[int, int]:
+        attempts, self._attempts = self._attempts, {}
+        return attempts
+
+    def restore_attempts(self, attempts: Dict[int, int]) -> None:
+        for user_id, n in attempts.items():
+            self._attempts[user_id] = self._attempts.get(user_id, 0) + n
+
+    def prune(self) -> None:
+        """Выкинуть пользователей без кулдауна, с полным ведром и давно без нарушений."""
+        now = monotonic()
+        for user_id in [uid for uid, st in self._state.items()
+                        if now >= st.blocked_until and st.bucket.full
+                        and now - st.last_block > ANSWER_COOLDOWN_MAX * 2]:
+            del self._state[user_id]
+
+answer_limiter = AnswerLimiter()
+
+async def flush_answer_attempts() -> None:
+    attempts = answer_limiter.drain_attempts()
+    try:
+        await add_attempts(attempts)
+    except Exception:
+        answer_limiter.restore_attempts(attempts)
+        raise
+
+async def flush_answer_attempts_loop() -> None:
+    while True:
+        await asyncio.sleep(ATTEMPTS_FLUSH_INTERVAL)
+        try:
+            await flush_answer_attempts()
+        except Exception:
+            logger.exception("failed to flush answer attempts")
+        answer_limiter.prune()
+
+
+# =========================
+# CIPHERS
+# =========================
+# Шифрование — пайплайн стадий над одним bytes-буфером: текст кодируется в UTF-8 один раз
+# на входе и декодируется один раз на выходе. Стадия: (метод, параметр) — параметр это
+# сдвиг для caesar, ключ для xor, у остальных None.
+Stage = Tuple[str, object]
+
+# Таблицы для bytes.translate: CAESAR_TABLES[shift] сдвигает латиницу, остальное не трогает
+def _caesar_table(shift: int) -> bytes:
+    lower = ALPHABET.encode("ascii")
+    upper = lower.upper()
+    return bytes.maketrans(lower + upper, lower[shift:] + lower[:shift] + upper[shift:] + upper[:shift])
+
+CAESAR_TABLES = [_caesar_table(shift) for shift in range(26)]
+
+def xor_bytes(data: bytes, key: bytes) -> bytes:
+    # XOR всего буфера разом: ключ повторяем до длины данных и ксорим как два больших int
+    n = len(data)
+    if n == 0:
+        return b""
+    stream = (key * (n // len(key) + 1))[:n]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(stream, "big")).to_bytes(n, "big")
+
+def _stage_url(data: bytes, _) -> bytes:
+    # percent-encoding каждого байта (как %2F%3A...): hexlify с разделителем — один проход
+    return b"%" + binascii.hexlify(data, b"%").upper() if data else b""
+
+def _stage_reverse(data: bytes, _) -> bytes:
+    # не-ASCII переворачиваем по символам, а не по байтам (иначе сломаем UTF-8)
+    return data[::-1] if data.isascii() else data.decode("utf-8")[::-1].encode("utf-8")
+
+STAGES = {
+    "caesar": lambda data, shift: data.translate(CAESAR_TABLES[shift % 26]),
+    "rot13": lambda data, _: data.translate(CAESAR_TABLES[13]),
+    "base64": lambda data, _: base64.b64encode(data),
+    "hex": lambda data, _: binascii.hexlify(data),
+    "url": _stage_url,
+    "xor": xor_bytes,
+    "reverse": _stage_reverse,
+}
+
+STAGE_HINTS = {
+    "caesar": "Caesar cipher, сдвиг = {}",
+    "rot13": "ROT13 (это Caesar со сдвигом 13)",
+    "base64": "Base64",
+    "hex": "HEX",
+    "url": "URL encoding (percent-encoding)",
+    "xor": "XOR, ключ (hex) = {}",
+    "reverse": "строка перевёрнута",
+}
+
+# Подсказки заданий одним методом — в прежней формулировке (xor — это XOR + Base64)
+METHOD_HINTS = {
+    "caesar": "Caesar cipher, сдвиг = {}",
+    "rot13": "ROT13 (это Caesar со сдвигом 13)",
+    "base64": "Base64",
+    "hex": "HEX → UTF-8",
+    "url": "URL encoding (percent-encoding)",
+    "xor": "XOR + Base64, ключ (hex) = {}",
+    "reverse": "строка просто перевёрнута",
+}
+
+# После xor буфер бинарный — его нужно закодировать в текст, иначе не запостить
+TEXT_ENCODING_STAGES = ("base64", "hex", "url")
+
+# Метод из METHODS = готовый пайплайн (xor — это XOR + Base64)
+METHOD_STAGES = {method: (method,) for method in METHODS}
+METHOD_STAGES["xor"] = ("xor", "base64")
+
+def _stage_param(method: str) -> object:
     if method == "caesar":
-        shift = random.randint(1, 25)
-        return caesar_encode(text, shift), f"Подсказка: Caesar cipher, сдвиг = {shift}"
-    if method == "rot13":
-        return rot13(text), "Подсказка: ROT13 (это Caesar со сдвигом 13)"
-    if method == "base64":
-        return b64_encode(text), "Подсказка: Base64"
-    if method == "hex":
-        return hex_encode(text), "Подсказка: HEX → UTF-8"
-    if method == "url":
-        return url_encode(text), "Подсказка: URL encoding (percent-encoding)"
+        return random.randint(1, 25)
     if method == "xor":
-        key = os.urandom(4)
-        return xor_encode(text, key), f"Подсказка: XOR + Base64, ключ (hex) = {key.hex()}"
-    if method == "reverse":
-        return reverse(text), "Подсказка: строка просто перевёрнута"
-    raise ValueError("Unknown method")
+        return os.urandom(4)
+    return None
+
+def make_pipeline(methods: Iterable[str]) -> List[Stage]:
+    """Стадии со случайными параметрами (сдвиг/ключ)"""
+    pipeline = []
+    for method in methods:
+        if method not in STAGES:
+            raise ValueError("Unknown method")
+        pipeline.append((method, _stage_param(method)))
+    return pipeline
+
+def random_pipeline(methods: List[str], depth: int) -> List[Stage]:
+    """
+    Случайная цепочка из depth стадий (сложность) из разрешённых methods.
+    Одна и та же стадия подряд не идёт, Caesar не идёт после Caesar/ROT13,
+    после xor обязательно кодирование в текст (может дать depth + 1 стадию).
+    Если подходящей стадии не осталось (разрешён один rot13), цепочка короче depth.
+    """
+    names: List[str] = []
+    while len(names) < depth or names[-1] == "xor":
+        last = names[-1] if names else None
+        if last == "xor":
+            options = [m for m in TEXT_ENCODING_STAGES if m in methods] or ["base64"]
+        else:
+            options = [
+                m for m in methods
+                if m != last and not (m in ("caesar", "rot13") and last in ("caesar", "rot13"))
+            ]
+        if not options:
+            break
+        names.append(random.choice(options))
+    return make_pipeline(names)
+
+def run_pipeline(pipeline: List[Stage], data: bytes) -> bytes:
+    for method, param in pipeline:
+        data = STAGES[method](data, param)
+    return data
+
+def pipeline_name(pipeline: List[Stage]) -> str:
+    return " → ".join(method for method, _ in pipeline)
+
+def _hint_param(param) -> object:
+    return param.hex() if isinstance(param, bytes) else param
+
+def pipeline_hint(pipeline: List[Stage], method: Optional[str] = None) -> str:
+    """method — пайплайн одного метода из METHODS (METHOD_STAGES): подсказка из METHOD_HINTS"""
+    if method is not None:
+        return "Подсказка: " + METHOD_HINTS[method].format(_hint_param(pipeline[0][1]))
+    parts = [STAGE_HINTS[stage].format(_hint_param(param)) for stage, param in pipeline]
+    if len(parts) == 1:
+        return "Подсказка: " + parts[0]
+    return "Подсказка (слои в порядке шифрования): " + " → ".join(parts)
+
+def encode_pipeline(pipeline: List[Stage], text: str, method: Optional[str] = None) -> Tuple[str, str]:
+    return run_pipeline(pipeline, text.encode("utf-8")).decode("utf-8"), pipeline_hint(pipeline, method)
+
+def _method_key(method: str) -> str:
+    key = method.lower()
+    if key not in METHOD_STAGES:
+        raise ValueError("Unknown method")
+    return key
+
+def encode_text(method: str, text: str) -> Tuple[str, str]:
+    key = _method_key(method)
+    return encode_pipeline(make_pipeline(METHOD_STAGES[key]), text, key)
+
+def encode_many(method: str, texts: List[str]) -> List[Tuple[str, str]]:
+    """encode_text() для пачки текстов (тот же контракт, случайный сдвиг/ключ — у каждого свой)"""
+    key = _method_key(method)
+    return [encode_pipeline(make_pipeline(METHOD_STAGES[key]), text, key) for text in texts]
+
+def build_challenge(payload: str, methods: List[str], difficulty: int) -> Tuple[str, str, str]:
+    """
+    Зашифровать задание: сложность 1 — один метод, N — цепочка из N слоёв.
+    Если сообщение не влезает в лимит Telegram, снижаем сложность.
+    Шифротекст, равный payload (rot13 цифр, caesar кириллицы, reverse палиндрома), отбрасываем:
+    иначе ответ публикуется открытым текстом.
+    returns: (метод или цепочка "xor → base64 → reverse", шифротекст, подсказка)
+    raises: ValueError, если ни один метод не меняет payload
+    """
+    result = None
+    for depth in range(min(max(difficulty, 1), MAX_DIFFICULTY), 0, -1):
+        if depth == 1:
+            candidates = [(method, make_pipeline(METHOD_STAGES[method]))
+                          for method in random.sample(methods, len(methods))]
+        else:
+            pipeline = random_pipeline(methods, depth)
+            candidates = [(pipeline_name(pipeline), pipeline)]
+        for method, pipeline in candidates:
+            encoded, hint = encode_pipeline(pipeline, payload, method if depth == 1 else None)
+            if encoded == payload:
+                continue
+            result = (method, encoded, hint)
+            if len(build_challenge_message(encoded, hint)) <= TELEGRAM_MAX_TEXT:
+                return result
+            break
+    if result is None:
+        raise ValueError("every allowed method leaves the payload unchanged")
+    return result
 
 def build_challenge_message(encoded: str, hint: str) -> str:
     return (
@@ -323,10 +2345,416 @@ def build_challenge_message(encoded: str, hint: str) -> str:
         "@nick_encoder_bot"
     )
 
+def build_challenge_caption(hint: str) -> str:
+    # подпись к заданию-картинке: шифротекст на самой картинке
+    return (
+        "🧩 *Mini-CTF дня*\n\n"
+        "Расшифруй то, что на картинке, и получи исходную ссылку/текст 👆\n\n"
+        f"📌 {hint}\n\n"
+        "✉️ *Ответ отправляй боту в личку* (чтобы никто не спойлерил):\n"
+        "@nick_encoder_bot"
+    )
+
+def markdown_error(text: str) -> Optional[str]:
+    """
+    Проверить разметку ParseMode.MARKDOWN так, как её разбирает Telegram:
+    *bold*, _italic_, `code`, [text](url) без вложенности; вне сущностей \\ экранирует _*`[.
+    returns: None или описание ошибки (такое сообщение Telegram не примет)
+    """
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i]
+        if ch == "\\" and i + 1 < n and text[i + 1] in "_*`[":
+            i += 2
+        elif ch in "*_`":
+            end = text.find(ch, i + 1)
+            if end == -1:
+                return f"unclosed {ch} at {i}"
+            i = end + 1
+        elif ch == "[":
+            end = text.find("]", i + 1)
+            if end == -1:
+                return f"unclosed [ at {i}"
+            if text.startswith("(", end + 1):
+                url_end = text.find(")", end + 2)
+                if url_end == -1:
+                    return f"unclosed link url at {end + 1}"
+                end = url_end
+            i = end + 1
+        else:
+            i += 1
+    return None
+
+# Их вывод — только [A-Za-z0-9+/=%]: в `code` всегда безопасен (запасной вариант для payload с `)
+MARKDOWN_SAFE_METHODS = ["base64", "hex", "url", "xor"]
+
+def build_ready_challenge(payload: str, methods: List[str], difficulty: int, image: bool) -> dict:
+    """
+    Задание, готовое к отправке: метод, шифротекст, подсказка и текст сообщения
+    (подпись, если картинкой) с проверенной разметкой и длиной.
+    Если шифротекст ломает разметку (например, ` в payload после caesar), шифруем заново
+    методами с безопасным выводом.
+    """
+    limit = TELEGRAM_MAX_CAPTION if image else TELEGRAM_MAX_TEXT
+    error = None
+    for candidates in (methods, MARKDOWN_SAFE_METHODS):
+        try:
+            method, encoded, hint = build_challenge(payload, candidates, difficulty)
+        except ValueError as e:
+            error = str(e)
+            logger.warning("challenge rejected (%s), re-encoding with safe methods", error)
+            continue
+        message = build_challenge_caption(hint) if image else build_challenge_message(encoded, hint)
+        if not image and "`" in encoded:
+            # ` внутри `code` не экранируется: разметка "сойдётся", но шифротекст покажется искажённым
+            error = "backtick in code"
+        else:
+            error = markdown_error(message)
+        if error is None and len(message) > limit:
+            error = f"message is {len(message)} chars"
+        if error is None:
+            return {"method": method, "payload": payload, "encoded": encoded, "hint": hint, "message": message}
+        logger.warning("challenge message rejected (%s), re-encoding with safe methods", error)
+    raise ValueError(f"cannot build a valid challenge message: {error}")
+
 def normalize(s: str) -> str:
     return s.strip()
 
 
+# =========================
+# CHALLENGE IMAGES
+# =========================
+# Шифротекст картинкой (его не скопировать). Рендер — заранее (prepare_job), шрифт и
+# раскладка кешируются; после первой отправки храним file_id и дальше шлём по нему.
+
+@functools.lru_cache(maxsize=4)
+def _image_font(size: int) -> ImageFont.ImageFont:
+    try:
+        return ImageFont.truetype(IMAGE_FONT_PATH, size)
+    except OSError:
+        logger.warning("font %s not found, using Pillow default", IMAGE_FONT_PATH)
+        return ImageFont.load_default(size)
+
+@functools.lru_cache(maxsize=256)
+def _image_layout(length: int, size: int) -> Tuple[int, int, int, int]:
+    """Моноширинная сетка под текст длины length: (символов в строке, высота строки, ширина, высота)"""
+    font = _image_font(size)
+    char_width = math.ceil(font.getlength("M"))
+    line_height = math.ceil(size * 1.4)
+    cols = max(1, min(IMAGE_MAX_COLS, length))
+    rows = max(1, math.ceil(length / cols))
+    return cols, line_height, cols * char_width + 2 * IMAGE_PADDING, rows * line_height + 2 * IMAGE_PADDING
+
+def render_challenge_image(encoded: str) -> bytes:
+    """PNG с шифротекстом. CPU-работа — вызывать через asyncio.to_thread."""
+    cols, line_height, width, height = _image_layout(len(encoded), IMAGE_FONT_SIZE)
+    font = _image_font(IMAGE_FONT_SIZE)
+    image = Image.new("RGB", (width, height), (24, 26, 33))
+    draw = ImageDraw.Draw(image)
+    for row, start in enumerate(range(0, len(encoded), cols)):
+        draw.text(
+            (IMAGE_PADDING, IMAGE_PADDING + row * line_height),
+            encoded[start:start + cols],
+            font=font,
+            fill=(120, 230, 140),
+        )
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# =========================
+# SOLVER (/decode)
+# =========================
+# Обратные к METHODS шаги над bytes; цепочки (base64 → xor, reverse → hex, ...) перебираются
+# beam search'ем. Кандидатов оцениваем по частотам байтов "обычного" текста/ссылок.
+
+# Частоты букв в английском тексте, %
+_ENGLISH_FREQ = {
+    "e": 12.7, "t": 9.1, "a": 8.2, "o": 7.5, "i": 7.0, "n": 6.7, "s": 6.3, "h": 6.1, "r": 6.0,
+    "d": 4.3, "l": 4.0, "c": 2.8, "u": 2.8, "m": 2.4, "w": 2.4, "f": 2.2, "g": 2.0, "y": 2.0,
+    "p": 1.9, "b": 1.5, "v": 1.0, "k": 0.8, "j": 0.15, "x": 0.15, "q": 0.1, "z": 0.07,
+}
+_URL_CHARS = b"/:.-_?=&%#~+@"
+_CONTROL_BYTES = bytes(b for b in range(0x20) if b not in b"\t\n\r") + b"\x7f"
+# в тексте (ASCII или кириллица в UTF-8) этих байтов нет
+_NOT_TEXT_BYTES = _CONTROL_BYTES + bytes(b for b in range(0xc0, 0x100) if b not in (0xd0, 0xd1))
+_ASCII_LETTERS = (ALPHABET + ALPHABET.upper()).encode("ascii")
+_HEX_DIGITS = b"0123456789abcdefABCDEF"
+_B64_CHARS = _ASCII_LETTERS + b"0123456789+/-_="
+_B64_URLSAFE = bytes.maketrans(b"-_", b"+/")
+# частые биграммы: отличают текст от перевёрнутого ("th" против "ht")
+_COMMON_BIGRAMS = (
+    b"th", b"he", b"in", b"er", b"an", b"re", b"on", b"at", b"en", b"nd",
+    b"ti", b"es", b"or", b"te", b"of", b"ed", b"is", b"it", b"al", b"ar",
+    b"st", b"to", b"nt", b"ng", b"ha", b"ou", b"ea", b"le", b"co", b"me",
+)
+# буквы UTF-8 с теми же ведущими байтами, но не из русского алфавита (Ѐ-Џ, ѐ-ѿ кроме ё) —
+# признак неверного ключа/сдвига
+_RARE_CYRILLIC_RE = re.compile(rb"\xd0[\x80-\x8f]|\xd1[\x90\x92-\xbf]")
+_TLD_RE = re.compile(rb"\.(com|org|net|ru|io|me|dev|info|xyz)\b", re.IGNORECASE)
+_URL_PREFIXES = (b"http://", b"https://", b"www.", b"t.me/")
+_FLAG_PREFIXES = (b"flag{", b"ctf{")
+_FLAG_RE = re.compile(rb"\s*(flag|ctf)\{[\x21-\x7e]*\}\s*\Z", re.IGNORECASE)
+# известные начала открытого текста: ключ XOR длиной до len(crib) восстанавливается из них напрямую
+_XOR_CRIBS = (b"https://", b"http://") + _FLAG_PREFIXES
+
+def _byte_log_probs() -> List[float]:
+    """log P(байт) для правдоподобного открытого текста: английский, русский (UTF-8), ссылки"""
+    probs = [1e-6] * 256
+    for b in range(0x20, 0x7f):
+        probs[b] = 0.001
+    for b in range(0x80, 0x100):
+        probs[b] = 0.004
+    # кириллица в UTF-8 — два байта: 0xD0/0xD1 и второй из 0x80..0xBF;
+    # в сумме буква оценивается примерно как средняя английская
+    for b in range(0x80, 0xc0):
+        probs[b] = 0.02
+    probs[0xd0] = probs[0xd1] = 0.12
+    for ch, freq in _ENGLISH_FREQ.items():
+        probs[ord(ch)] = freq / 100 * 0.6
+        probs[ord(ch.upper())] = freq / 100 * 0.04
+    for b in b"0123456789":
+        probs[b] = 0.004
+    for b in _URL_CHARS:
+        probs[b] = 0.01
+    probs[ord(" ")] = 0.08
+    probs[ord("\n")] = 0.005
+    return [math.log(p) for p in probs]
+
+_BYTE_LOG_PROBS = _byte_log_probs()
+
+def _xor_class_tables() -> Tuple[List[bytes], List[float]]:
+    """
+    Для подбора байта XOR-ключа: XOR_CLASS_TABLES[key] переводит байт шифротекста сразу
+    в класс расшифрованного байта (по _BYTE_LOG_PROBS, с шагом 1 нат) — оценка колонки
+    это несколько bytes.count() вместо цикла по байтам
+    """
+    classes = bytes(min(int(-lp), 13) for lp in _BYTE_LOG_PROBS)
+    weights = [-(c + 0.5) for c in range(14)]
+    return [bytes(classes[b ^ key] for b in range(256)) for key in range(256)], weights
+
+XOR_CLASS_TABLES, _XOR_CLASS_WEIGHTS = _xor_class_tables()
+
+XOR_TABLES = [bytes(b ^ key for b in range(256)) for key in range(256)]
+
+def text_score(data: bytes) -> float:
+    """Средний log P на байт + бонус за ссылку. Больше — правдоподобнее."""
+    score = sum(data.count(b) * _BYTE_LOG_PROBS[b] for b in set(data)) / len(data)
+    if data[:8].lower().startswith(_URL_PREFIXES) or _FLAG_RE.match(data):
+        score += 3.0
+    elif b"://" in data:
+        score += 1.0
+    if _TLD_RE.search(data):
+        score += 0.5
+    lower = data.lower()
+    score += 4.0 * sum(lower.count(bigram) for bigram in _COMMON_BIGRAMS) / len(data)
+    if not data.isascii():
+        score -= 8.0 * len(_RARE_CYRILLIC_RE.findall(data)) / len(data)
+    return score
+
+def is_plaintext(data: bytes) -> bool:
+    # валидный UTF-8 и почти без управляющих символов
+    if len(data) - len(data.translate(None, _CONTROL_BYTES)) > len(data) // 50:
+        return False
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def _unbase64(data: bytes) -> Optional[bytes]:
+    s = data.strip()
+    if len(s) < 4 or s.translate(None, _B64_CHARS):
+        return None
+    s = s.rstrip(b"=").translate(_B64_URLSAFE)
+    if len(s) % 4 == 1:
+        return None
+    try:
+        return base64.b64decode(s + b"=" * (-len(s) % 4), validate=True)
+    except binascii.Error:
+        return None
+
+def _unhex(data: bytes) -> Optional[bytes]:
+    s = data.strip()
+    if len(s) < 2 or len(s) % 2 or s.translate(None, _HEX_DIGITS):
+        return None
+    return bytes.fromhex(s.decode("ascii"))
+
+def _decodes_to_text(data: Optional[bytes]) -> bool:
+    return bool(data) and is_plaintext(data)
+
+def _caesar_candidate_score(data: bytes) -> float:
+    # Caesar поверх base64/hex/url (цепочка base64 → caesar): сам сдвиг похож на шум,
+    # поэтому заглядываем на шаг вперёд и оцениваем то, что декодируется
+    score = text_score(data)
+    for decoded in (_unbase64(data), _unhex(data), urllib.parse.unquote_to_bytes(data) if b"%" in data else None):
+        if decoded and decoded != data and is_plaintext(decoded):
+            score = max(score, text_score(decoded))
+    return score
+
+def caesar_guess(data: bytes, keep: int = 2) -> List[Tuple[int, bytes]]:
+    """Все 25 сдвигов, оставляем keep лучших. returns: [(сдвиг шифрования, текст)]"""
+    candidates = [(shift, data.translate(CAESAR_TABLES[-shift % 26])) for shift in range(1, 26)]
+    candidates.sort(key=lambda c: _caesar_candidate_score(c[1]), reverse=True)
+    return candidates[:keep]
+
+def _xor_plain_score(data: bytes, key: bytes) -> float:
+    plain = xor_bytes(data, key)
+    return text_score(plain) if is_plaintext(plain) else text_score(plain) - 10.0
+
+def _xor_refine_key(data: bytes, options: List[List[int]]) -> bytes:
+    """options — лучшие байты ключа по каждой колонке. На коротком data уточняем ключ
+    покоординатно по text_score всего текста (биграммы, валидный UTF-8)."""
+    key = bytearray(column[0] for column in options)
+    if len(data) // len(key) >= XOR_REFINE_MAX_COLUMN:
+        return bytes(key)
+    for _ in range(2):
+        for col, column in enumerate(options):
+            def score(kb: int) -> float:
+                key[col] = kb
+                return _xor_plain_score(data, bytes(key))
+            key[col] = max(column, key=score)
+    return bytes(key)
+
+def xor_guess(data: bytes, keep: int = 2) -> List[Tuple[bytes, bytes]]:
+    """
+    Повторяющийся ключ длиной 1..XOR_MAX_KEY: байт ключа для каждой колонки (data[i::k])
+    подбираем по частотам байтов; длины, где колонка не даёт печатный текст, отбрасываем.
+    returns: [(ключ, текст)] — keep лучших по text_score (длинный ключ подгоняется под
+    шум, поэтому за каждый байт ключа небольшой штраф)
+    """
+    keys = set()
+    crib_keys = set()
+    for k in range(1, min(XOR_MAX_KEY, len(data) // 2) + 1):
+        options = []
+        for col in range(k):
+            column = data[col::k]
+            if len(column) < XOR_REFINE_MAX_COLUMN:
+                # короткая колонка: классы по 1 нат дают много ничьих — считаем точно
+                def column_score(kb: int) -> float:
+                    return sum(_BYTE_LOG_PROBS[b] for b in column.translate(XOR_TABLES[kb]))
+            else:
+                def column_score(kb: int) -> float:
+                    return sum(column.translate(XOR_CLASS_TABLES[kb]).count(c) * w
+                               for c, w in enumerate(_XOR_CLASS_WEIGHTS))
+            ranked = sorted(range(256), key=column_score, reverse=True)
+            # колонка не похожа на текст — длина ключа не та
+            garbage = len(column) - len(column.translate(XOR_TABLES[ranked[0]]).translate(None, _NOT_TEXT_BYTES))
+            if garbage > 0.1 * len(column):
+                break
+            options.append(ranked[:XOR_KEY_OPTIONS])
+        else:
+            keys.add(_xor_refine_key(data, options))
+        # по частотам короткие колонки часто ошибаются в регистре/соседнем символе — crib точнее;
+        # ключ из первых k байт проверяем на остатке crib (повторённый ключ должен его дать)
+        for crib in _XOR_CRIBS:
+            if k < len(crib) <= len(data):
+                key = xor_bytes(data[:k], crib[:k])
+                if xor_bytes(data[:len(crib)], key) == crib:
+                    crib_keys.add(key)
+            elif k == len(crib) < len(data) and crib in _FLAG_PREFIXES:
+                # проверить не на чем: флаг целиком (с "}" в конце) отличит text_score
+                keys.add(xor_bytes(data[:k], crib))
+
+    candidates = {}
+    # ключ, подтверждённый crib'ом, надёжнее частотного — тогда частотные не нужны
+    for group in (crib_keys, keys):
+        for key in group:
+            plain = xor_bytes(data, key)
+            if plain not in candidates and is_plaintext(plain):
+                candidates[plain] = (text_score(plain) - 0.05 * len(key), key)
+        if candidates:
+            break
+    ranked = sorted(candidates.items(), key=lambda c: c[1][0], reverse=True)
+    return [(key, plain) for plain, (_, key) in ranked[:keep]]
+
+def _decode_steps(data: bytes, path: tuple) -> Iterator[Tuple[str, str, bytes]]:
+    """Шаги, применимые к data: (метод, подпись, результат). Заведомо бесполезные не пробуем."""
+    last = path[-1][0] if path else None
+    out = _unbase64(data)
+    if out is not None:
+        yield "base64", "base64", out
+    out = _unhex(data)
+    if out is not None:
+        yield "hex", "hex", out
+    if b"%" in data:
+        out = urllib.parse.unquote_to_bytes(data)
+        if out != data:
+            yield "url", "url", out
+    plain = is_plaintext(data)
+    if last != "reverse":
+        # как _stage_reverse: UTF-8 — по символам, иначе по байтам
+        yield "reverse", "reverse", data.decode("utf-8")[::-1].encode("utf-8") if plain else data[::-1]
+    # сдвиг после сдвига — тоже сдвиг; по не-тексту Caesar не гоняем. Строку из алфавита hex
+    # или base64, которая сама декодируется в текст, тоже: сдвиг шума "выигрывает" у настоящего
+    # текста (кириллица, короткие флаги). base64 → caesar при этом остаётся: сдвинутый base64
+    # декодируется в мусор
+    if (last != "caesar" and plain and data.translate(None, _ASCII_LETTERS) != data
+            and _unhex(data) is None and not _decodes_to_text(_unbase64(data))):
+        for shift, out in caesar_guess(data):
+            yield "caesar", "rot13" if shift == 13 else f"caesar (сдвиг {shift})", out
+    # XOR — по "бинарным" данным и не больше одного раза за цепочку
+    if not plain and all(method != "xor" for method, _ in path):
+        for key, out in xor_guess(data):
+            yield "xor", f"xor (ключ {key.hex()})", out
+
+def solve_cipher(ciphertext: str, limit: int = SOLVER_RESULTS) -> List[Tuple[str, str]]:
+    """
+    Подобрать расшифровку: beam search по цепочкам обратных шагов (до SOLVER_MAX_DEPTH),
+    не дольше SOLVER_TIME_BUDGET сек. Чистая CPU-работа — вызывать через asyncio.to_thread.
+    returns: до limit пар (цепочка, открытый текст), лучшие первыми
+    """
+    deadline = perf_counter() + SOLVER_TIME_BUDGET
+    root = ciphertext.strip().encode("utf-8")
+    seen = {root}
+    found: Dict[bytes, Tuple[float, tuple]] = {}
+    frontier = [(root, ())]
+    for _ in range(SOLVER_MAX_DEPTH):
+        children = []
+        for data, path in frontier:
+            for method, label, out in _decode_steps(data, path):
+                # BFS: первый найденный путь к результату — самый короткий
+                if not out or out in seen:
+                    continue
+                seen.add(out)
+                score = text_score(out)
+                step_path = path + ((method, label),)
+                if is_plaintext(out):
+                    # при прочих равных короткая цепочка вероятнее
+                    found[out] = (score - 0.1 * len(step_path), step_path)
+                children.append((score, out, step_path))
+            if perf_counter() > deadline:
+                break
+        if perf_counter() > deadline:
+            break
+        children.sort(key=lambda c: c[0], reverse=True)
+        frontier = [(out, path) for _, out, path in children[:SOLVER_BEAM]]
+
+    ranked = sorted(found.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    return [(" → ".join(label for _, label in path), out.decode("utf-8")) for out, (_, path) in ranked]
+
+def shares_most_of(text: str, secret: str) -> bool:
+    """В text (без учёта регистра) есть не меньше SPOILER_SHARE символов secret"""
+    text, secret = text.casefold(), secret.casefold()
+    if not secret:
+        return False
+    min_block = min(SPOILER_MIN_BLOCK, len(secret))
+    blocks = difflib.SequenceMatcher(None, secret, text, autojunk=False).get_matching_blocks()
+    return sum(b.size for b in blocks if b.size >= min_block) >= SPOILER_SHARE * len(secret)
+
+def spoils_active(ciphertext: str, results: List[Tuple[str, str]], actives: List[dict]) -> bool:
+    """Почти шифротекст живого задания или расшифровка почти его ответ (в т.ч. перевёрнутый)"""
+    for challenge in actives:
+        if shares_most_of(ciphertext, challenge["encoded"]):
+            return True
+        for _, plaintext in results:
+            if (shares_most_of(plaintext, challenge["answer_norm"])
+                    or shares_most_of(plaintext[::-1], challenge["answer_norm"])):
+                return True
+    return False
+
+
 # =========================
 # COMMANDS
 # =========================
@@ -337,15 +2765,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🧠 *Справка по командам бота*\n\n"
         "📌 *Основное*\n"
         "• /methods — методы шифрования\n"
+        "• /decode <шифр> — подобрать расшифровку (можно reply на сообщение)\n"
         "• /chatid — показать chat_id (для настройки)\n\n"
         "🧩 *Mini-CTF*\n"
         "• /add <текст/ссылка> — добавить задание в очередь\n"
+        "• /addmany — добавить несколько заданий (по одному на строку)\n"
+        "• .txt/.csv файлом — импорт заданий (админ; в группе — с подписью /import)\n"
         "• /queue — сколько заданий в очереди\n"
         "• /postnow — запостить Mini-CTF прямо сейчас (только админ)\n\n"
+        "⚙️ *Настройка чата* (только админ, в группе)\n"
+        "• /setup — постить Mini-CTF в эту ветку\n"
+        "• /settime ЧЧ:ММ — время ежедневного поста\n"
+        "• /setmethods caesar,xor,... — какие методы использовать (all — все)\n"
+        f"• /setdifficulty 1-{MAX_DIFFICULTY} — сколько слоёв шифрования в задании\n"
+        "• /setimage on|off — задание картинкой (не скопировать)\n"
+        "• /repost — повторить текущее задание ветки\n\n"
         "🏆 *Прогресс*\n"
         "• /profile — твой профиль (ранг + решения)\n"
         "  ↳ можно ответить (reply) на сообщение человека и написать /profile — покажет его профиль\n"
-        "• /leaderboard — топ-10 по решениям\n\n"
+        "• /leaderboard [страница] — топ по решениям (по 10 на страницу)\n"
+        "• /stats — статистика заданий: решения, время до первого решения, по методам и дням\n\n"
         "✅ *Как засчитывается решение*\n"
         "Ответ пишем *только в личные сообщения боту*.\n"
         "В группе ответы можно писать, но бот удалит их (если у него есть право удалять)."
@@ -355,6 +2794,141 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def methods_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Методы: " + ", ".join(METHODS))
 
+async def decode_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /decode <шифр> или reply на сообщение с шифром
+    parts = (update.message.text or "").split(maxsplit=1)
+    reply = update.message.reply_to_message
+    ciphertext = parts[1] if len(parts) > 1 else (reply.text or reply.caption or "") if reply else ""
+    if not ciphertext.strip():
+        await update.message.reply_text("Использование: /decode <зашифрованный текст> (или reply на сообщение)")
+        return
+    # текущие задания не решаем за людей. Шифротекст можно переписать (без "=", HEX заглавными,
+    # минус символ) — поэтому сравниваем нестрого, и с заданием, и с расшифровками.
+    # CPU-работа — в отдельном потоке, чтобы не держать event loop
+    actives = await get_active_challenges()
+    if await asyncio.to_thread(spoils_active, ciphertext.strip(), [], actives):
+        await update.message.reply_text("🙈 Это задание ещё идёт — решай сам!")
+        return
+    results = await asyncio.to_thread(solve_cipher, ciphertext)
+    if await asyncio.to_thread(spoils_active, ciphertext.strip(), results, actives):
+        await update.message.reply_text("🙈 Это задание ещё идёт — решай сам!")
+        return
+    if not results:
+        await update.message.reply_text("🤷 Не получилось подобрать расшифровку.")
+        return
+    lines = ["🔎 Варианты расшифровки:"]
+    for i, (chain, plaintext) in enumerate(results, 1):
+        if len(plaintext) > 500:
+            plaintext = plaintext[:500] + "…"
+        lines.append(f"\n{i}. {chain}\n{plaintext}")
+    await update.message.reply_text("\n".join(lines))
+
+def thread_kwargs(thread_id: int) -> dict:
+    # thread_id 0 — группа без веток (topics)
+    return {"message_thread_id": thread_id} if thread_id else {}
+
+def queue_chat_id(update: Update) -> int:
+    # в группе — очередь этой группы, в личке — чата по умолчанию (TARGET_CHAT_ID)
+    chat = update.effective_chat
+    return TARGET_CHAT_ID if chat.type == "private" else chat.id
+
+async def is_chat_admin(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> bool:
+    member = await context.bot.get_chat_member(chat_id, user_id)
+    return member.status in ("administrator", "creator")
+
+def describe_chat_settings(settings: dict) -> str:
+    methods = ", ".join(settings["methods"]) if settings["methods"] else "все"
+    return (
+        f"⚙️ Ветка: {settings['thread_id'] or '—'}\n"
+        f"⏰ Время поста: {settings['post_time'].strftime('%H:%M')}\n"
+        f"🔐 Методы: {methods}\n"
+        f"🧱 Сложность: {settings['difficulty']}\n"
+        f"🖼 Картинкой: {'да' if settings['image'] else 'нет'}"
+    )
+
+async def require_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: str) -> bool:
+    if update.effective_chat.type == "private":
+        await update.message.reply_text(f"ℹ️ /{cmd} работает только в группе")
+        return False
+    if not await is_chat_admin(context, update.effective_chat.id, update.effective_user.id):
+        await update.message.reply_text(f"⛔ Только админы могут делать /{cmd}")
+        return False
+    return True
+
+async def setup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_group_admin(update, context, "setup"):
+        return
+    msg = update.message
+    thread_id = msg.message_thread_id if msg.is_topic_message else 0
+    # если сегодняшнее время поста уже прошло — первый пост завтра, а не прямо сейчас
+    skip_today = datetime.now().time() >= DAILY_POST_TIME
+    settings = await setup_chat(update.effective_chat.id, thread_id or 0, skip_today)
+    await msg.reply_text("✅ Mini-CTF будет поститься сюда.\n\n" + describe_chat_settings(settings))
+
+async def settime_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_group_admin(update, context, "settime"):
+        return
+    try:
+        post_time = datetime.strptime(context.args[0], "%H:%M").time()
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /settime ЧЧ:ММ (например /settime 09:00)")
+        return
+    settings = await update_chat_settings(update.effective_chat.id, post_time=post_time)
+    if not settings:
+        await update.message.reply_text("ℹ️ Сначала /setup в ветке для Mini-CTF")
+        return
+    await update.message.reply_text("✅ Готово.\n\n" + describe_chat_settings(settings))
+
+async def setmethods_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_group_admin(update, context, "setmethods"):
+        return
+    names = [m.strip().lower() for m in " ".join(context.args).replace(",", " ").split()]
+    if not names:
+        await update.message.reply_text("Использование: /setmethods caesar,xor,... или /setmethods all")
+        return
+    if names == ["all"]:
+        names = []
+    unknown = [m for m in names if m not in METHODS]
+    if unknown:
+        await update.message.reply_text("❌ Неизвестные методы: " + ", ".join(unknown))
+        return
+    settings = await update_chat_settings(update.effective_chat.id, methods=names)
+    if not settings:
+        await update.message.reply_text("ℹ️ Сначала /setup в ветке для Mini-CTF")
+        return
+    await update.message.reply_text("✅ Готово.\n\n" + describe_chat_settings(settings))
+
+async def setdifficulty_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_group_admin(update, context, "setdifficulty"):
+        return
+    try:
+        difficulty = int(context.args[0])
+    except (IndexError, ValueError):
+        difficulty = 0
+    if not 1 <= difficulty <= MAX_DIFFICULTY:
+        await update.message.reply_text(
+            f"Использование: /setdifficulty 1-{MAX_DIFFICULTY} (1 — один метод, {MAX_DIFFICULTY} — цепочка из {MAX_DIFFICULTY})"
+        )
+        return
+    settings = await update_chat_settings(update.effective_chat.id, difficulty=difficulty)
+    if not settings:
+        await update.message.reply_text("ℹ️ Сначала /setup в ветке для Mini-CTF")
+        return
+    await update.message.reply_text("✅ Готово.\n\n" + describe_chat_settings(settings))
+
+async def setimage_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_group_admin(update, context, "setimage"):
+        return
+    arg = context.args[0].lower() if context.args else ""
+    if arg not in ("on", "off"):
+        await update.message.reply_text("Использование: /setimage on или /setimage off")
+        return
+    settings = await update_chat_settings(update.effective_chat.id, image=arg == "on")
+    if not settings:
+        await update.message.reply_text("ℹ️ Сначала /setup в ветке для Mini-CTF")
+        return
+    await update.message.reply_text("✅ Готово.\n\n" + describe_chat_settings(settings))
+
 async def chatid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"chat_id: {update.effective_chat.id}")
 
@@ -363,12 +2937,69 @@ async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         await update.message.reply_text("Использование: /add <ссылка или текст>")
         return
-    c = queue_push(text)
+    chat_id = queue_chat_id(update)
+    if chat_id == 0:
+        await update.message.reply_text("ℹ️ Добавляй задания командой /add в группе")
+        return
+    c = await queue_push(chat_id, text)
     await update.message.reply_text(f"✅ Добавлено в очередь! Сейчас в очереди: {c}")
 
+async def addmany_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # одно задание на строку: /addmany <первое>\n<второе>\n...
+    parts = (update.message.text or "").split(maxsplit=1)
+    body = parts[1] if len(parts) > 1 else ""
+    payloads = [line.strip() for line in body.splitlines() if line.strip()]
+    if not payloads:
+        await update.message.reply_text("Использование: /addmany и задания — по одному на строку")
+        return
+    chat_id = queue_chat_id(update)
+    if chat_id == 0:
+        await update.message.reply_text("ℹ️ Добавляй задания командой /addmany в группе")
+        return
+    c = await queue_push_many(chat_id, payloads)
+    await update.message.reply_text(f"✅ Добавлено в очередь: {len(payloads)}. Сейчас в очереди: {c}")
+
+def iter_import_payloads(path: str, is_csv: bool) -> Iterator[str]:
+    """Задания из файла по одному: строка .txt или первая колонка .csv (заголовок payload пропускаем)."""
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as f:
+        if is_csv:
+            for i, cells in enumerate(csv.reader(f)):
+                payload = cells[0].strip() if cells else ""
+                if payload and not (i == 0 and payload.lower() == "payload"):
+                    yield payload
+        else:
+            for line in f:
+                payload = line.strip()
+                if payload:
+                    yield payload
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = queue_chat_id(update)
+    if chat_id == 0:
+        await update.message.reply_text("ℹ️ Присылай файл с подписью /import в группе")
+        return
+    if not await is_chat_admin(context, chat_id, update.effective_user.id):
+        await update.message.reply_text("⛔ Импортировать задания могут только админы")
+        return
+
+    document = update.message.document
+    is_csv = (document.file_name or "").lower().endswith(".csv")
+    # Bot API отдаёт файл целиком (до 20 МБ) — кладём на диск и читаем построчно,
+    # в COPY строки уходят по одной, список всех заданий в памяти не собирается
+    tg_file = await document.get_file()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = await tg_file.download_to_drive(os.path.join(tmp, "import"))
+        total, inserted, c = await queue_import(chat_id, iter_import_payloads(str(path), is_csv))
+
+    await update.message.reply_text(
+        f"✅ Импорт: добавлено {inserted}, пропущено дублей {total - inserted}. Сейчас в очереди: {c}"
+    )
+
 async def queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    c = queue_count()
-    await update.message.reply_text(f"📦 В очереди: {c}")
+    chat_id = queue_chat_id(update)
+    c = await queue_count(chat_id)
+    ready = await prepared_count(chat_id)
+    await update.message.reply_text(f"📦 В очереди: {c}" + (f" (+{ready} уже подготовлены к посту)" if ready else ""))
 
 async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # если reply — показываем профиль того пользователя
@@ -379,97 +3010,277 @@ async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = int(target.id)
     username = target.username or target.first_name or "Unknown"
-    upsert_user(user_id, target.username or "", target.first_name or "")
-
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT solves, rank FROM users WHERE user_id=%s;", (user_id,))
-            row = cur.fetchone()
+    row = await remember_user(user_id, target.username or "", target.first_name or "")
 
-    solves = int(row["solves"]) if row else 0
-    rank = row["rank"] if row else get_rank(0)
+    solves = int(row["solves"])
+    rank = row["rank"] or get_rank(solves)
 
-    await update.message.reply_text(
+    text = (
         f"👤 *{username}*\n"
         f"Ранг: {rank}\n"
-        f"Решено: *{solves}*",
-        parse_mode=ParseMode.MARKDOWN
+        f"Решено: *{solves}*"
     )
+    if solves > 0:
+        place, total = await leaderboard.position(solves)
+        text += f"\nМесто: #{place} из {total}"
+
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
 async def leaderboard_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT user_id, COALESCE(username, first_name) AS name, solves, rank
-                FROM users
-                WHERE solves > 0
-                ORDER BY solves DESC
-                LIMIT 10;
-            """)
-            rows = cur.fetchall()
+    # /leaderboard [страница]
+    page = 1
+    if context.args and context.args[0].isdigit():
+        page = max(int(context.args[0]), 1)
+
+    size = LEADERBOARD_PAGE_SIZE
+    rows = await leaderboard.page(page, size)
 
     if not rows:
-        await update.message.reply_text("📭 Пока никто не решил ни одного Mini-CTF.")
+        if page == 1:
+            await update.message.reply_text("📭 Пока никто не решил ни одного Mini-CTF.")
+        else:
+            await update.message.reply_text(f"📭 Страницы {page} нет.")
         return
 
-    text = "🏆 *Leaderboard*\n\n"
-    for i, r in enumerate(rows, start=1):
+    text = "🏆 *Leaderboard*" + (f" (стр. {page})" if page > 1 else "") + "\n\n"
+    for i, r in enumerate(rows, start=(page - 1) * size + 1):
         name = r["name"] or str(r["user_id"])
         rank = r["rank"] or get_rank(int(r["solves"]))
         text += f"{i}. {rank} *{name}* — {r['solves']} ✅\n"
 
-    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    if page * size < leaderboard.total:
+        text += f"\nДальше: /leaderboard {page + 1}"
 
-async def post_challenge(app: Application, chat_id: int) -> None:
-    if chat_id == 0 or MINI_CTF_THREAD_ID == 0:
-        raise RuntimeError("Set TARGET_CHAT_ID and MINI_CTF_THREAD_ID env vars")
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
-    payload = queue_pop_fifo()
-    if not payload:
-        await app.bot.send_message(
-            chat_id=chat_id,
-            message_thread_id=MINI_CTF_THREAD_ID,
-            text="📭 Сегодня очередь пустая. Добавь задания командой: /add <ссылка/текст>",
-        )
+def format_duration(seconds: int) -> str:
+    if seconds < 60:
+        return f"{seconds} сек"
+    if seconds < 3600:
+        return f"{seconds // 60} мин"
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours} ч {rest // 60} мин" if rest >= 60 else f"{hours} ч"
+
+def histogram_median(hist: List[int]) -> Optional[str]:
+    """Медиана времени решения по гистограмме SOLVE_TIME_BUCKETS — с точностью до корзины"""
+    total = sum(hist)
+    if not total:
+        return None
+    seen = 0
+    for i, n in enumerate(hist):
+        seen += n
+        if seen * 2 >= total:
+            if i < len(SOLVE_TIME_BUCKETS):
+                return "≤ " + format_duration(SOLVE_TIME_BUCKETS[i])
+            return "> " + format_duration(SOLVE_TIME_BUCKETS[-1])
+    return None
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /stats — статистика заданий (по роллапам, без сканирования истории)
+    stats = await get_stats(queue_chat_id(update))
+    if not stats["methods"]:
+        await update.message.reply_text("📭 Пока не было ни одного Mini-CTF.")
         return
 
-    method = random.choice(METHODS)
-    encoded, hint = encode_text(method, payload)
-    msg = build_challenge_message(encoded, hint)
-
-    sent = await app.bot.send_message(
-        chat_id=chat_id,
-        message_thread_id=MINI_CTF_THREAD_ID,
-        text=msg,
-        parse_mode=ParseMode.MARKDOWN
+    lines = ["📊 Статистика Mini-CTF", "", "Последние задания:"]
+    for c in stats["challenges"]:
+        line = f"• #{c['challenge_id']} {c['method']} ({c['created_at']:%d.%m}) — {c['solves']} ✅"
+        if c["first_solve_seconds"] is not None:
+            line += f", первое за {format_duration(c['first_solve_seconds'])}"
+        median = histogram_median(c["solve_time_hist"])
+        if median:
+            line += f", медиана {median}"
+        lines.append(line)
+    if not stats["challenges"]:
+        lines.append("• в этом чате ещё не было")
+
+    lines += ["", "По методам:"]
+    for m in stats["methods"]:
+        line = f"• {m['method']}: {m['challenges']} заданий, {m['solves']} ✅"
+        if m["first_solves"]:
+            avg = m["first_solve_seconds_sum"] // m["first_solves"]
+            line += f", первое в среднем за {format_duration(avg)}"
+        median = histogram_median(m["solve_time_hist"])
+        if median:
+            line += f", медиана {median}"
+        lines.append(line)
+
+    if stats["daily"]:
+        lines += ["", f"Решений по дням ({STATS_DAYS} дн.):"]
+        for d in stats["daily"]:
+            lines.append(f"• {d['day']:%d.%m}: {d['solves']} ✅ / {d['challenges']} заданий")
+
+    await update.message.reply_text("\n".join(lines))
+
+async def prepare_challenges(chat_id: int, settings: dict, count: int) -> int:
+    """
+    Подготовить до count заданий из очереди чата (шифр, сообщение, картинка) и сохранить
+    в prepared_challenges. Задание, которое не зашифровать (например, слишком длинное),
+    выкидываем из очереди с предупреждением и берём следующее — остальные не страдают.
+    returns: сколько подготовлено (0 — очередь пуста)
+    """
+    methods = [m for m in settings["methods"] if m in METHOD_STAGES] or METHODS
+    prepared = 0
+    while prepared < count:
+        items = await queue_pop_items(chat_id, count - prepared)
+        if not items:
+            break
+        kept, challenges = [], []
+        try:
+            for item in items:
+                try:
+                    challenge = build_ready_challenge(item["payload"], methods, int(settings["difficulty"]),
+                                                      settings["image"])
+                except ValueError as e:
+                    logger.warning("chat %s: dropping queue item %s (%s)", chat_id, item["id"], e)
+                    metrics.inc("bot_queue_rejected_total", "reason", "encode")
+                    continue
+                kept.append(item)
+                challenge["image"] = (
+                    await asyncio.to_thread(render_challenge_image, challenge["encoded"])
+                    if settings["image"] else None
+                )
+                challenges.append(challenge)
+            if challenges:
+                await save_prepared_challenges(chat_id, challenges)
+        except Exception:
+            if kept:
+                await queue_restore(chat_id, kept)  # не теряем задания и их место в очереди
+            raise
+        prepared += len(challenges)
+    return prepared
+
+async def send_challenge(chat_id: int, thread_id: int, message: str, image,
+                         parse_mode: Optional[str] = ParseMode.MARKDOWN) -> Message:
+    """image — PNG (bytes) или file_id уже загруженной картинки (message — подпись); None — текстом"""
+    kwargs = {"photo": image} if image is not None else {}
+    return await outbox.send(
+        chat_id,
+        message,
+        priority=PRIORITY_GROUP,
+        parse_mode=parse_mode,
+        **kwargs,
+        **thread_kwargs(thread_id),
     )
 
-    # Деактивируем старое активное задание, создаём новое
-    deactivate_old_challenges(chat_id, MINI_CTF_THREAD_ID)
-    create_challenge(
-        chat_id=chat_id,
-        thread_id=MINI_CTF_THREAD_ID,
-        message_id=sent.message_id,
-        method=method,
-        payload=payload,
-        encoded=encoded,
-        answer=payload,
-        hint=hint
-    )
+async def post_challenge(app: Application, chat_id: int, settings: Optional[dict] = None) -> None:
+    if settings is None:
+        settings = await get_chat_settings(chat_id)
+    if not settings:
+        raise RuntimeError(f"Chat {chat_id} is not set up: run /setup in its Mini-CTF topic")
+    thread_id = int(settings["thread_id"])
+
+    async def send(prepared: dict) -> Message:
+        image, message = prepared["image"], prepared["message"]
+        parse_mode = ParseMode.MARKDOWN
+        # подготовлено до смены /setimage (или до migration 9) — собираем сообщение сейчас
+        if message is None or bool(settings["image"]) != (image is not None):
+            image = (
+                await asyncio.to_thread(render_challenge_image, prepared["encoded"]) if settings["image"] else None
+            )
+            if image is not None:
+                message = build_challenge_caption(prepared["hint"])
+            else:
+                message = build_challenge_message(prepared["encoded"], prepared["hint"])
+            if markdown_error(message):
+                parse_mode = None
+        return await send_challenge(
+            chat_id, thread_id, message, bytes(image) if image is not None else None, parse_mode
+        )
+
+    # обычно задание подготовлено заранее (prepare_job) и пост — это только отправка + один INSERT
+    row = await activate_prepared_challenge(chat_id, thread_id, send)
+    if row is None and await prepare_challenges(chat_id, settings, 1):
+        row = await activate_prepared_challenge(chat_id, thread_id, send)
+    if row is None:
+        await outbox.send(
+            chat_id,
+            "📭 Сегодня очередь пустая. Добавь задания командой: /add <ссылка/текст>",
+            priority=PRIORITY_GROUP,
+            **thread_kwargs(thread_id),
+        )
 
 async def postnow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # только админы
-    member = await context.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
-    if member.status not in ("administrator", "creator"):
-        await update.message.reply_text("⛔ Только админы могут делать /postnow")
+    if not await require_group_admin(update, context, "postnow"):
+        return
+    settings = await get_chat_settings(update.effective_chat.id)
+    if not settings:
+        await update.message.reply_text("ℹ️ Сначала /setup в ветке для Mini-CTF")
         return
 
-    await post_challenge(context.application, update.effective_chat.id)
+    await post_challenge(context.application, update.effective_chat.id, settings)
+
+async def repost_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # повторить текущее задание ветки (картинка — по file_id, без рендера и аплоада)
+    if not await require_group_admin(update, context, "repost"):
+        return
+    msg = update.message
+    chat_id = update.effective_chat.id
+    thread_id = msg.message_thread_id if msg.is_topic_message else 0
+    current = await get_active_challenge(chat_id, thread_id or 0)
+    if not current:
+        await msg.reply_text("❌ В этой ветке сейчас нет активного Mini-CTF.")
+        return
+    if current["image_file_id"]:
+        message = build_challenge_caption(current["hint"])
+    else:
+        message = build_challenge_message(current["encoded"], current["hint"])
+    await send_challenge(
+        chat_id, thread_id or 0, message, current["image_file_id"],
+        None if markdown_error(message) else ParseMode.MARKDOWN,
+    )
 
 async def daily_job(context: ContextTypes.DEFAULT_TYPE):
-    if TARGET_CHAT_ID == 0:
+    # Раз в SCHEDULER_INTERVAL: какие чаты сегодня ещё не постили, а время уже пришло.
+    # job зарегистрирован во всех процессах, постит только лидер
+    if not await leader.confirm():
+        return
+    now = datetime.now()
+    due = await claim_due_chats(now.time(), now.date())
+    if not due:
+        return
+
+    sem = asyncio.Semaphore(POST_CONCURRENCY)
+
+    async def post(settings: dict) -> None:
+        async with sem:
+            try:
+                await post_challenge(context.application, int(settings["chat_id"]), settings)
+            except Exception:
+                logger.exception("daily post to chat %s failed", settings["chat_id"])
+
+    await asyncio.gather(*(post(settings) for settings in due))
+
+async def prepare_job(context: ContextTypes.DEFAULT_TYPE):
+    # Заранее, а не в момент поста: у каждого чата PREPARE_AHEAD готовых заданий
+    if not await leader.confirm():
+        return
+    released = await release_stale_claims(PREPARE_CLAIM_TIMEOUT)
+    if released:
+        logger.warning("released %s stale prepared challenge claim(s)", released)
+    for settings in await chats_to_prepare(PREPARE_AHEAD):
+        chat_id = int(settings["chat_id"])
+        try:
+            await prepare_challenges(chat_id, settings, PREPARE_AHEAD - int(settings["prepared"]))
+        except Exception:
+            logger.exception("preparing challenges for chat %s failed", chat_id)
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    # Пачками, каждая в своей транзакции: блокировки короткие, autovacuum успевает за удалениями
+    if RETENTION_DAYS <= 0 or not await leader.confirm():
         return
-    await post_challenge(context.application, TARGET_CHAT_ID)
+    total_challenges = total_solves = 0
+    while True:
+        challenges, solves = await archive_challenges_batch(RETENTION_DAYS, ARCHIVE_BATCH_SIZE)
+        total_challenges += challenges
+        total_solves += solves
+        if challenges < ARCHIVE_BATCH_SIZE:
+            break
+    if total_challenges:
+        metrics.inc("bot_archived_total", "table", "challenges", total_challenges)
+        metrics.inc("bot_archived_total", "table", "challenge_solves", total_solves)
+        logger.info("archived %s challenges, %s solves", total_challenges, total_solves)
 
 
 # =========================
@@ -482,8 +3293,12 @@ async def check_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 1) Если человек пишет ответ В ГРУППЕ в Mini-CTF ветке — удаляем (если можем) и просим писать в ЛС
     if update.effective_chat.type != "private":
-        # удаляем только если это в нужной ветке
-        if msg.message_thread_id == MINI_CTF_THREAD_ID:
+        # удаляем только если в этой ветке идёт задание
+        thread_id = msg.message_thread_id or 0
+        _, current = active_challenges.get(update.effective_chat.id, thread_id)
+        # в чате без тем (thread_id 0) задание делит ленту с обычной перепиской —
+        # удаляем только сам ответ
+        if current is not None and (thread_id or normalize(msg.text) == current["answer_norm"]):
             try:
                 await msg.delete()
             except Exception:
@@ -491,73 +3306,224 @@ async def check_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # (по желанию) можно отправить подсказку в личку, если бот уже видел пользователя
         return
 
-    # 2) В ЛС — проверяем ответ
-    current = get_active_challenge()
-    if not current:
-        await msg.reply_text("❌ Сейчас нет активного Mini-CTF.")
-        return
-
+    # 2) В ЛС — проверяем ответ. Ответы уходят через outbox без ожидания доставки:
+    # "Верно" и "Новый ранг" склеятся в одно сообщение.
     user = update.effective_user
-    upsert_user(user.id, user.username or "", user.first_name or "")
 
-    challenge_id = int(current["id"])
-    if has_solved(challenge_id, user.id):
-        await msg.reply_text("ℹ️ Ты уже решил это задание.")
+    # Сначала лимит попыток — без БД; спам дальше этой строки не проходит
+    verdict, wait = answer_limiter.check(user.id)
+    if verdict == AnswerLimiter.NOTIFY:
+        metrics.inc("bot_answers_limited_total", "verdict", "notify")
+        outbox.submit(msg.chat_id, f"⏳ Слишком много попыток. Подожди {int(wait) + 1} сек.")
+        return
+    if verdict == AnswerLimiter.DROP:
+        metrics.inc("bot_answers_limited_total", "verdict", "drop")
         return
 
-    user_answer = normalize(msg.text)
-    correct = normalize(current["answer"] or "")
+    # Ответ в личке может относиться к заданию любого чата — ищем совпадение среди всех активных
+    actives = await get_active_challenges()
+    if not actives:
+        outbox.submit(msg.chat_id, "❌ Сейчас нет активного Mini-CTF.")
+        return
 
-    if user_answer != correct:
-        await msg.reply_text("❌ Неверно. Попробуй ещё раз 👀")
+    user_answer = normalize(msg.text)
+    matches = [c for c in actives if c["answer_norm"] == user_answer]
+
+    if not matches:
+        entry = await remember_user(user.id, user.username or "", user.first_name or "")
+        solved = await user_solved(entry, user.id, [int(c["id"]) for c in actives])
+        if len(solved) == len(actives):
+            outbox.submit(msg.chat_id, "ℹ️ Ты уже решил это задание.")
+            return
+        outbox.submit(msg.chat_id, "❌ Неверно. Попробуй ещё раз 👀")
         return
 
-    # ✅ Засчитываем
-    mark_solved(challenge_id, user.id)
+    # ✅ Засчитываем (решение + solves + ранг — одним запросом)
+    result = None
+    for current in matches:
+        result = await submit_answer(int(current["id"]), user.id, user.username or "", user.first_name or "")
+        if result is not None:
+            break
+    if result is None:
+        outbox.submit(msg.chat_id, "ℹ️ Ты уже решил это задание.")
+        return
 
-    new_solves, old_rank, new_rank = add_solve(user.id)
+    new_solves, old_rank, new_rank = result
 
-    await msg.reply_text(
+    outbox.submit(
+        msg.chat_id,
         "🎉 Верно!\n\n"
         f"🏆 Всего решений: {new_solves}\n"
         f"Ранг: {new_rank}"
     )
 
     if new_rank != old_rank:
-        await msg.reply_text(f"🎉 Новый ранг: {new_rank}")
+        outbox.submit(msg.chat_id, f"🎉 Новый ранг: {new_rank}")
+
+
+# =========================
+# UPDATE PROCESSING
+# =========================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты обрабатываются параллельно (до max_concurrent_updates), но апдейты одного
+    пользователя (или чата, если пользователя нет) — строго по очереди, в порядке прихода.
+    """
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        # Семафор базового класса держится и пока апдейт ждёт очереди своего пользователя,
+        # поэтому он фактически отключён, а лимит параллельности — свой, берётся после
+        # пользовательской блокировки: ждущие своей очереди апдейты слоты не занимают.
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+
+    @staticmethod
+    def _key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._slots:
+                    await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if self._waiting[key] == 0:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 # =========================
 # MAIN
 # =========================
+_background_tasks: List[asyncio.Task] = []
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+async def on_startup(app: Application, **connect_kwargs) -> None:
+    global _metrics_server
+    await db_open(**connect_kwargs)
+    await init_db()
+    await seed_default_chat()
+    await warm_active_challenges()
+    _background_tasks.append(asyncio.create_task(listen_active_challenges()))
+    _background_tasks.append(asyncio.create_task(watch_event_loop_lag()))
+    _background_tasks.append(asyncio.create_task(flush_answer_attempts_loop()))
+    _background_tasks.append(asyncio.create_task(leader.run()))
+    outbox.start(app.bot)
+    _metrics_server = await start_metrics_server()
+
+async def on_shutdown(app: Application) -> None:
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+    profiler.stop()
+    await outbox.stop()
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await leader.close()
+    try:
+        await flush_answer_attempts()
+    except Exception:
+        logger.exception("failed to flush answer attempts on shutdown")
+    await db_close()
+
+def register_handlers(app: Application) -> None:
+    # Commands
+    app.add_handler(CommandHandler("start", timed_handler(start)))
+    app.add_handler(CommandHandler("methods", timed_handler(methods_cmd)))
+    app.add_handler(CommandHandler("decode", timed_handler(decode_cmd)))
+    app.add_handler(CommandHandler("chatid", timed_handler(chatid_cmd)))
+    app.add_handler(CommandHandler("add", timed_handler(add_cmd)))
+    app.add_handler(CommandHandler("addmany", timed_handler(addmany_cmd)))
+    app.add_handler(CommandHandler("queue", timed_handler(queue_cmd)))
+    app.add_handler(CommandHandler("postnow", timed_handler(postnow_cmd)))
+    app.add_handler(CommandHandler("setup", timed_handler(setup_cmd)))
+    app.add_handler(CommandHandler("settime", timed_handler(settime_cmd)))
+    app.add_handler(CommandHandler("setmethods", timed_handler(setmethods_cmd)))
+    app.add_handler(CommandHandler("setdifficulty", timed_handler(setdifficulty_cmd)))
+    app.add_handler(CommandHandler("setimage", timed_handler(setimage_cmd)))
+    app.add_handler(CommandHandler("repost", timed_handler(repost_cmd)))
+    app.add_handler(CommandHandler("profile", timed_handler(profile_cmd)))
+    app.add_handler(CommandHandler("leaderboard", timed_handler(leaderboard_cmd)))
+    app.add_handler(CommandHandler("stats", timed_handler(stats_cmd)))
+
+    # Any text (answers) -> checker
+    app.add_handler(MessageHandler(
+        (filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"))
+        & (filters.ChatType.PRIVATE | filters.CaptionRegex(r"^/import\b")),
+        timed_handler(import_document),
+    ))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(check_answer)))
+
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("Set BOT_TOKEN env var")
     if not DATABASE_URL:
         raise RuntimeError("Set DATABASE_URL env var")
 
-    init_db()
-
-    app = Application.builder().token(BOT_TOKEN).build()
-
-    # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("methods", methods_cmd))
-    app.add_handler(CommandHandler("chatid", chatid_cmd))
-    app.add_handler(CommandHandler("add", add_cmd))
-    app.add_handler(CommandHandler("queue", queue_cmd))
-    app.add_handler(CommandHandler("postnow", postnow_cmd))
-    app.add_handler(CommandHandler("profile", profile_cmd))
-    app.add_handler(CommandHandler("leaderboard", leaderboard_cmd))
-
-    # Any text (answers) -> checker
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_answer))
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(TimedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    register_handlers(app)
 
-    # Daily post
+    # Daily post: раз в минуту проверяем, каким чатам пора (время у каждого чата своё)
     # Важно: для PTB job_queue нужен пакет python-telegram-bot[job-queue]
-    app.job_queue.run_daily(daily_job, time=DAILY_POST_TIME)
-
-    app.run_polling()
+    app.job_queue.run_repeating(timed_handler(daily_job), interval=SCHEDULER_INTERVAL, first=SCHEDULER_INTERVAL)
+    # Подготовка заданий заранее (только на лидере)
+    app.job_queue.run_repeating(timed_handler(prepare_job), interval=PREPARE_INTERVAL, first=SCHEDULER_INTERVAL)
+    # Архивация старых заданий (тоже только на лидере)
+    app.job_queue.run_repeating(timed_handler(archive_job), interval=ARCHIVE_INTERVAL, first=ARCHIVE_INTERVAL)
+
+    # На остановке (SIGTERM) PTB перестаёт принимать апдейты и дожидается уже принятых,
+    # потом on_shutdown дописывает outbox и закрывает пул.
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("Set WEBHOOK_URL env var for BOT_MODE=webhook")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    elif BOT_MODE == "polling":
+        app.run_polling()
+    else:
+        raise RuntimeError(f"Unknown BOT_MODE={BOT_MODE!r} (use polling or webhook)")
 
 if __name__ == "__main__":
     main()